@@ -0,0 +1,222 @@
+"""Scale benchmark of the gRPC cloud provider.
+
+Start CloudProvider on a synthetic inventory of N instances spread across M
+node groups, backed by an in-process fake provider and a fake Kubernetes API,
+then drive the RPC sequence issued by cluster-autoscaler on each loop:
+Refresh, NodeGroups, NodeGroupForNode for every registered node, then
+NodeGroupTargetSize, NodeGroupNodes and NodeGroupTemplateNodeInfo per group.
+
+    python benchmarks/scale.py --sizes 100 1000 10000 50000 --groups 10
+"""
+import argparse
+import asyncio
+import os
+import string
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import yaml
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+sys.path.append(os.path.join(SRC, "protos"))
+
+import grpc
+from protos import externalgrpc_pb2_grpc
+from protos.externalgrpc_pb2 import NodeGroupsRequest, RefreshRequest, NodeGroupForNodeRequest, NodeGroupTargetSizeRequest, \
+        NodeGroupNodesRequest, NodeGroupTemplateNodeInfoRequest
+
+import server
+# Imported ahead so the startup measures the inventory, not the import of the kubernetes client
+import kube_operator
+from providers.base import ProviderBase, ProviderStatus
+
+RUNNING_RATIO = 0.5
+SPECS = {"cpus": 16, "gpus": 0, "ram": 65536}
+
+
+def group_name(index):
+    """Group ids are the non-digit prefix of the node names, so they are made of letters only"""
+    name = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        name = string.ascii_lowercase[remainder] + name
+    return f"group{name}"
+
+
+def write_config(path, size, groups, syntax):
+    config = {"provider": {"minikube": None}}
+    if syntax == "groups":
+        counts = [size // groups + (1 if g < size % groups else 0) for g in range(groups)]
+        config["groups"] = [{"id": group_name(g), "instances": f"{group_name(g)}[1-{count}]", "specs": SPECS}
+                            for g, count in enumerate(counts) if count > 0]
+    else:
+        config["instances"] = [{f"{group_name(i % groups)}{i}": {"specs": SPECS}} for i in range(size)]
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+
+
+class FakeProvider(ProviderBase):
+    """Report the first RUNNING_RATIO of the nodes as running and apply changes instantly"""
+    OWN_CLUSTER = True
+
+    def __init__(self, managed_nodes, config=None):
+        super().__init__(managed_nodes)
+        running = int(len(managed_nodes) * RUNNING_RATIO)
+        self.running = set(n.name for n in managed_nodes[:running])
+
+    def get_nodes_status(self):
+        return {n.name: ProviderStatus.RUNNING if n.name in self.running else ProviderStatus.SHUTDOWN
+                for n in self.managed_nodes}
+
+    def sync_status(self, apply_changes=True):
+        nodes_status = self.get_nodes_status()
+        if not self._should_apply(apply_changes):
+            return nodes_status
+        nodes_to_start, nodes_to_stop = self._get_changes(nodes_status)
+        for n in nodes_to_start:
+            self.running.add(n.name)
+            n.flag = None
+        for n in nodes_to_stop:
+            self.running.discard(n.name)
+            n.flag = None
+        return self.get_nodes_status()
+
+    def kube_client(self):
+        return FakeCoreV1Api(self), IdleWatch
+
+
+class FakeCoreV1Api:
+    """List the running nodes of the fake provider as Ready Kubernetes nodes"""
+    def __init__(self, provider: FakeProvider):
+        self.provider = provider
+
+    @staticmethod
+    def _node(name):
+        return SimpleNamespace(
+                metadata=SimpleNamespace(name=name),
+                spec=SimpleNamespace(provider_id=f"minikube://{name}"),
+                status=SimpleNamespace(conditions=[SimpleNamespace(type="Ready", status="True")]))
+
+    def list_node(self, **kwargs):
+        items = [self._node(name) for name in self.provider.running]
+        return SimpleNamespace(items=items, metadata=SimpleNamespace(resource_version="1"))
+
+    def patch_node(self, name, body, **kwargs):
+        pass
+
+    def delete_node(self, name, **kwargs):
+        pass
+
+
+class IdleWatch:
+    """Watch stream without any event, blocking until stopped"""
+    resource_version = None
+
+    def __init__(self):
+        self._stop = threading.Event()
+
+    def stream(self, func, **kwargs):
+        self._stop.wait()
+        return
+        yield
+
+    def stop(self):
+        self._stop.set()
+
+
+class BenchCloudProvider(server.CloudProvider):
+    def _provider_class(self, config):
+        return FakeProvider
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def timed(latencies, name, call):
+    start = time.perf_counter()
+    response = await call
+    latencies.setdefault(name, []).append(time.perf_counter() - start)
+    return response
+
+
+async def autoscaler_loop(stub, node_names, latencies):
+    await timed(latencies, "Refresh", stub.Refresh(RefreshRequest()))
+    node_groups = await timed(latencies, "NodeGroups", stub.NodeGroups(NodeGroupsRequest()))
+    for name in node_names:
+        await timed(latencies, "NodeGroupForNode", stub.NodeGroupForNode(NodeGroupForNodeRequest(node={"name": name})))
+    for ng in node_groups.nodeGroups:
+        await timed(latencies, "NodeGroupTargetSize", stub.NodeGroupTargetSize(NodeGroupTargetSizeRequest(id=ng.id)))
+        await timed(latencies, "NodeGroupNodes", stub.NodeGroupNodes(NodeGroupNodesRequest(id=ng.id)))
+        await timed(latencies, "NodeGroupTemplateNodeInfo",
+                    stub.NodeGroupTemplateNodeInfo(NodeGroupTemplateNodeInfoRequest(id=ng.id)))
+
+
+async def run(size, groups, loops, max_staleness, syntax):
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "config.yaml")
+        write_config(config_path, size, groups, syntax)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        cloud_provider = BenchCloudProvider(config_path=config_path, max_staleness=max_staleness)
+        startup = time.perf_counter() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    grpc_server = grpc.aio.server()
+    externalgrpc_pb2_grpc.add_CloudProviderServicer_to_server(cloud_provider, grpc_server)
+    port = grpc_server.add_insecure_port("127.0.0.1:0")
+    await grpc_server.start()
+
+    latencies = {}
+    loop_times = []
+    node_names = sorted(cloud_provider.provider.running)
+    try:
+        async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+            stub = externalgrpc_pb2_grpc.CloudProviderStub(channel)
+            for _ in range(loops):
+                start = time.perf_counter()
+                await autoscaler_loop(stub, node_names, latencies)
+                loop_times.append(time.perf_counter() - start)
+    finally:
+        cloud_provider.operator.informer.stop()
+        await grpc_server.stop(None)
+
+    return startup, memory, loop_times, latencies
+
+
+def report(size, groups, startup, memory, loop_times, latencies):
+    print(f"\n{size} nodes, {groups} groups: startup {startup:.3f}s, "
+          f"memory {memory / 2**20:.1f}MiB ({memory / size:.0f}B/node), "
+          f"loop p50 {percentile(loop_times, 0.5):.3f}s max {max(loop_times):.3f}s")
+    print(f"  {'RPC':<28}{'calls':>8}{'p50 (ms)':>12}{'p99 (ms)':>12}")
+    for name, values in latencies.items():
+        print(f"  {name:<28}{len(values):>8}{percentile(values, 0.5) * 1e3:>12.3f}{percentile(values, 0.99) * 1e3:>12.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scale benchmark of the gRPC cloud provider")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 50000])
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--loops", type=int, default=3)
+    parser.add_argument("--max-staleness", type=float, default=0,
+                        help="Default to 0 so every Refresh goes through a full sync")
+    parser.add_argument("--syntax", choices=["groups", "instances"], default="groups",
+                        help="Declare the inventory with group ranges or one instance at a time")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        results = asyncio.run(run(size, args.groups, args.loops, args.max_staleness, args.syntax))
+        report(size, args.groups, *results)
+
+
+if __name__ == "__main__":
+    main()
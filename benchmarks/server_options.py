@@ -0,0 +1,99 @@
+"""Compare the gRPC server settings on a synthetic inventory.
+
+Each setting serves the same CloudProvider, see scale.py, and is driven with
+sequential NodeGroupNodes calls on every group, then bursts of concurrent
+NodeGroupForNode calls like a cluster autoscaler looping over its nodes.
+
+    python benchmarks/server_options.py --size 10000 --groups 4
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import grpc
+
+import scale
+import server
+from protos import externalgrpc_pb2_grpc
+from protos.externalgrpc_pb2 import NodeGroupsRequest, NodeGroupForNodeRequest, NodeGroupNodesRequest
+
+NODES_COMPRESSION_THRESHOLD = 64 * 1024 # bytes
+
+SETTINGS = {
+    "default": (server.ServerOptions(), None, False),
+    "gzip-nodes": (server.ServerOptions(), NODES_COMPRESSION_THRESHOLD, False),
+    "gzip-all": (server.ServerOptions(compression="gzip"), None, False),
+    "max-rpcs-64": (server.ServerOptions(max_concurrent_rpcs=64), None, False),
+    "uvloop": (server.ServerOptions(), None, True),
+}
+
+
+async def run(cloud_provider, options, nodes_threshold, node_names, loops, concurrency):
+    options = server.ServerOptions(**{**options.__dict__, "listen_address": "127.0.0.1:0"})
+    cloud_provider.nodes_compression_threshold = nodes_threshold
+    grpc_server, port = server.create_server(cloud_provider, options)
+    await grpc_server.start()
+
+    nodes_latencies = []
+    burst_times = []
+    rejected = 0
+    try:
+        async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+            stub = externalgrpc_pb2_grpc.CloudProviderStub(channel)
+            node_groups = await stub.NodeGroups(NodeGroupsRequest())
+            for _ in range(loops):
+                for ng in node_groups.nodeGroups:
+                    start = time.perf_counter()
+                    await stub.NodeGroupNodes(NodeGroupNodesRequest(id=ng.id))
+                    nodes_latencies.append(time.perf_counter() - start)
+
+                for i in range(0, len(node_names), concurrency):
+                    calls = [stub.NodeGroupForNode(NodeGroupForNodeRequest(node={"name": name}))
+                             for name in node_names[i:i + concurrency]]
+                    start = time.perf_counter()
+                    results = await asyncio.gather(*calls, return_exceptions=True)
+                    burst_times.append(time.perf_counter() - start)
+                    rejected += sum(1 for r in results if isinstance(r, grpc.aio.AioRpcError))
+    finally:
+        await grpc_server.stop(None)
+
+    return nodes_latencies, burst_times, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the gRPC server settings")
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument("--loops", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=256, help="NodeGroupForNode calls in flight per burst")
+    parser.add_argument("--settings", nargs="+", choices=list(SETTINGS), default=list(SETTINGS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "config.yaml")
+        scale.write_config(config_path, args.size, args.groups, "groups")
+        cloud_provider = scale.BenchCloudProvider(config_path=config_path)
+    node_names = sorted(cloud_provider.provider.running)
+
+    print(f"{args.size} nodes, {args.groups} groups, bursts of {args.concurrency} NodeGroupForNode")
+    print(f"  {'setting':<14}{'Nodes p50 (ms)':>16}{'Nodes p99 (ms)':>16}{'burst p50 (ms)':>16}{'rejected':>10}")
+    try:
+        for name in args.settings:
+            options, nodes_threshold, use_uvloop = SETTINGS[name]
+            loop_factory = server.event_loop_factory(use_uvloop)
+            if use_uvloop and loop_factory is None:
+                continue
+            with asyncio.Runner(loop_factory=loop_factory) as runner:
+                nodes_latencies, burst_times, rejected = runner.run(
+                        run(cloud_provider, options, nodes_threshold, node_names, args.loops, args.concurrency))
+            print(f"  {name:<14}{scale.percentile(nodes_latencies, 0.5) * 1e3:>16.3f}"
+                  f"{scale.percentile(nodes_latencies, 0.99) * 1e3:>16.3f}"
+                  f"{scale.percentile(burst_times, 0.5) * 1e3:>16.3f}{rejected:>10}")
+    finally:
+        cloud_provider.operator.informer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,76 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+import re
 import yaml
 
+from providers.registry import load_provider
 
-@dataclass
-class Config:
-    @dataclass
-    class TFE:
-        token: str
-        workspace: str
-        id = "tfe"
+# libyaml parses large inventories an order of magnitude faster than the pure Python loader
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-    @dataclass
-    class Minikube:
-        id = "minikube"
+RANGE_REGEX = re.compile(r'\[([^\]]+)\]')
+
+
+def expand_names(pattern: str) -> Iterator[str]:
+    """Yield the names of a pattern like `gpu[001-512]` or `node[1-4,8]`.
+    The width of the range start is kept as zero padding, several brackets expand as a product.
+    """
+    match = RANGE_REGEX.search(pattern)
+    if match is None:
+        yield pattern
+        return
+
+    prefix, suffix = pattern[:match.start()], pattern[match.end():]
+    for part in match.group(1).split(","):
+        start, sep, end = part.strip().partition("-")
+        if not start.isdigit() or (sep and not end.isdigit()) or int(end or start) < int(start):
+            raise Exception(f"Invalid range [{match.group(1)}] in instance pattern {pattern}")
+        for i in range(int(start), int(end or start) + 1):
+            for rest in expand_names(suffix):
+                yield f"{prefix}{i:0{len(start)}d}{rest}"
 
+
+@dataclass
+class Config:
     @dataclass
     class Instance:
         name: str
         specs: dict
+        group: Optional[str] = None
+
+    @dataclass
+    class Group:
+        id: str
+        instances: str | List[str] # names or range patterns
+        specs: dict
+
+        def names(self) -> Iterator[str]:
+            patterns = [self.instances] if isinstance(self.instances, str) else self.instances
+            for pattern in patterns:
+                yield from expand_names(pattern)
 
-    provider: TFE | Minikube
+    provider: object # config schema of the selected provider, see providers.registry
     instances: List[Instance]
+    groups: List[Group] = field(default_factory=list)
 
     @staticmethod
     def from_yaml(yaml_path):
         with open(yaml_path, 'r') as f:
-           config = yaml.safe_load(f)
+           config = yaml.load(f, Loader=SafeLoader)
 
         provider_config = config['provider']
         match list(provider_config.keys()):
-            case [Config.Minikube.id]:
-                provider = Config.Minikube()
-            case [Config.TFE.id]:
-                provider = Config.TFE(**provider_config['tfe'])
+            case [provider_id]:
+                # Only the selected provider is imported, it declares the schema of its section
+                provider_class = load_provider(provider_id)
+                provider = provider_class.config_schema(**(provider_config[provider_id] or {}))
             case _:
                 raise Exception("Invalid provider in config file")
         instances = []
-        for instance in config['instances']:
+        for instance in config.get('instances') or []:
             assert len(instance) == 1
             for name, param in instance.items():
                 instances.append(Config.Instance(name=name, **param))
+        groups = [Config.Group(**group) for group in config.get('groups') or []]
 
-        return Config(provider=provider, instances=instances)
+        return Config(provider=provider, instances=instances, groups=groups)
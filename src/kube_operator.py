@@ -1,9 +1,12 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from providers.base import ProviderStatus
 logger = logging.getLogger(__name__)
 
-from typing import List
+from dataclasses import dataclass
+from typing import List, Optional
 from kubernetes import client, config, watch
 from kubernetes.client.models import v1_node_condition
 from kubernetes.client.exceptions import ApiException
@@ -23,18 +26,163 @@ class OperatorStatus(StrEnum):
     DISCONNECTED = 'Unknown' # Node disconnected (network issue or node shutdown)
     DELETED = auto() # Node not present in the cluster
 
+@dataclass(frozen=True)
+class CachedNode:
+    status: OperatorStatus
+    provider_id: Optional[str]
+
+class NodeInformer:
+    """Keep an in-memory view of the managed nodes of the cluster.
+
+    The nodes are listed once, then a background watch resumes from the last
+    resourceVersion. When the API server answers 410 Gone, the cache is rebuilt
+    from a new list.
+    """
+    WATCH_TIMEOUT = 300 # seconds, the server closes the watch after this delay
+    RETRY_DELAY = 5 # seconds
+    HTTP_GONE = 410
+
+    def __init__(self, api: client.CoreV1Api, names: List[str], watcher=watch.Watch):
+        self.api = api
+        self.names = set(names)
+        self._watcher = watcher
+        self._nodes: dict[str, CachedNode] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.resource_version = None
+
+    @staticmethod
+    def _to_cached_node(node) -> CachedNode:
+        status = KubeOperator._get_status_from_node_codition(node.status.conditions or [])
+        return CachedNode(status=status, provider_id=node.spec.provider_id)
+
+    def _list(self):
+        node_list = self.api.list_node()
+        nodes = {}
+        for n in node_list.items:
+            if n.metadata.name in self.names:
+                nodes[n.metadata.name] = self._to_cached_node(n)
+        with self._lock:
+            self._nodes = nodes
+        self.resource_version = node_list.metadata.resource_version
+        logger.debug(f"Node informer listed {len(nodes)} managed nodes at {self.resource_version=}")
+
+    def _handle_event(self, event):
+        # Bookmarks only carry a resourceVersion, the watch records it and does not deserialize them
+        if event['type'] == 'BOOKMARK':
+            return
+        node = event['object']
+        if not isinstance(node, client.V1Node):
+            logger.debug(f"Node informer ignored a {event['type']} event without a node")
+            return
+        name = node.metadata.name
+        if name not in self.names:
+            return
+        with self._lock:
+            match event['type']:
+                case 'ADDED' | 'MODIFIED':
+                    self._nodes[name] = self._to_cached_node(node)
+                case 'DELETED':
+                    self._nodes.pop(name, None)
+
+    def _watch(self):
+        w = self._watcher()
+        try:
+            for event in w.stream(self.api.list_node, resource_version=self.resource_version,
+                                  timeout_seconds=self.WATCH_TIMEOUT, allow_watch_bookmarks=True):
+                if self._stop.is_set():
+                    break
+                self._handle_event(event)
+        finally:
+            w.stop()
+            # The watch keeps track of the last resourceVersion, including bookmarks
+            if w.resource_version is not None:
+                self.resource_version = w.resource_version
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.resource_version is None:
+                    self._list()
+                self._watch()
+            except ApiException as e:
+                if e.status == self.HTTP_GONE:
+                    logger.info("Node informer resourceVersion expired, listing nodes again")
+                    self.resource_version = None
+                else:
+                    logger.warning(f"Node informer watch failed: {e}")
+                    self._stop.wait(self.RETRY_DELAY)
+            except Exception as e:
+                logger.warning(f"Node informer watch failed: {e}")
+                self._stop.wait(self.RETRY_DELAY)
+
+    def set_names(self, names: List[str]):
+        """Track a new set of nodes. Added nodes are listed right away instead of waiting for a relist."""
+        names = set(names)
+        added = names - self.names
+        self.names = names
+        with self._lock:
+            self._nodes = {name: n for name, n in self._nodes.items() if name in names}
+        if not added:
+            return
+
+        node_list = self.api.list_node()
+        with self._lock:
+            for n in node_list.items:
+                if n.metadata.name in added:
+                    # A watch event received since the names changed is newer than the list
+                    self._nodes.setdefault(n.metadata.name, self._to_cached_node(n))
+
+    def start(self):
+        self._list()
+        self._thread = threading.Thread(target=self._run, name="node-informer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get(self, name) -> Optional[CachedNode]:
+        with self._lock:
+            return self._nodes.get(name)
+
+    def snapshot(self) -> dict[str, CachedNode]:
+        with self._lock:
+            return dict(self._nodes)
+
+def load_kube_config():
+    try:
+        # Try config file from env variable
+        config.load_kube_config()
+    except ConfigException:
+        # Otherwise, load from cluster (running as pod)
+        config.load_incluster_config()
+
 class KubeOperator:
     READY_TYPE = 'Ready'
+    PATCH_WORKERS = 4
+    MERGE_PATCH = 'application/merge-patch+json'
+    HTTP_NOT_FOUND = 404
 
-    def __init__(self, managed_nodes: List[Node]):
+    def __init__(self, managed_nodes: List[Node], api: Optional[client.CoreV1Api] = None, watcher=watch.Watch):
         self.managed_nodes = managed_nodes
-        try:
-            # Try config file from env variable
-            config.load_kube_config()
-        except ConfigException:
-            # Otherwise, load from cluster (running as pod)
-            config.load_incluster_config()
-        self.api = client.CoreV1Api()
+        if api is None:
+            load_kube_config()
+            api = client.CoreV1Api()
+        self.api = api
+        self.informer = NodeInformer(self.api, [n.name for n in managed_nodes], watcher=watcher)
+        self.informer.start()
+        self._patch_executor = ThreadPoolExecutor(max_workers=self.PATCH_WORKERS, thread_name_prefix="patch-node")
+        # Nodes with a provider id patch in flight, or sent but not yet seen by the informer
+        self._patched: set[str] = set()
+        self._patched_lock = threading.Lock()
+
+    def set_managed_nodes(self, managed_nodes: List[Node]):
+        self.informer.set_names([n.name for n in managed_nodes])
+        self.managed_nodes = managed_nodes
+        names = set(n.name for n in managed_nodes)
+        with self._patched_lock:
+            self._patched &= names
 
     @staticmethod
     def _get_status_from_node_codition(conditions : list[v1_node_condition.V1NodeCondition]) -> OperatorStatus:
@@ -53,21 +201,61 @@ class KubeOperator:
                 break
         return status
 
-    def _get_status(self) -> dict[str, OperatorStatus]:
-        nodes = {n.name: OperatorStatus.DELETED for n in self.managed_nodes}
-
-        for n in self.api.list_node().items:
-            name = n.metadata.name
-            if name in nodes.keys():
-                status = self._get_status_from_node_codition(n.status.conditions)
-                nodes[name] = status
+    def _get_status(self, cached_nodes: dict[str, CachedNode]) -> dict[str, OperatorStatus]:
+        nodes = {}
+        for n in self.managed_nodes:
+            cached_node = cached_nodes.get(n.name)
+            nodes[n.name] = cached_node.status if cached_node else OperatorStatus.DELETED
         return nodes
 
     def _delete_node(self, node):
-        self.api.delete_node(node.name)
+        try:
+            self.api.delete_node(node.name)
+        except ApiException as e:
+            # The informer cache can lag behind a deletion already sent
+            if e.status != self.HTTP_NOT_FOUND:
+                raise
+
+    def _patch_provider_id(self, name, provider_id):
+        try:
+            # Only send the field to set instead of the whole Node object
+            body = {"spec": {"providerID": provider_id}}
+            self.api.patch_node(name, body, _content_type=self.MERGE_PATCH)
+            logger.info(f"Set provider_id={provider_id} to node={name}")
+        except ApiException as e:
+            logger.warning(f"Error reaching node={name}: {e}")
+            # Retry on next sync
+            with self._patched_lock:
+                self._patched.discard(name)
+
+    def _check_provider_id(self, node: Node, cached_node: Optional[CachedNode]):
+        # TODO: We need to set ProviderID={n.get_id()}.
+        # It would be favorable to use an independant kubelet config file on each node to set the coresponding provider_id.
+        # For now, the provider id of each node is checked from the informer cache and only missing ones are patched.
+        if cached_node is None:
+            return
 
-    def sync_status(self, nodes_provider_status: dict[str, ProviderStatus]):
-        nodes_operator_status = self._get_status()
+        if cached_node.provider_id is None:
+            with self._patched_lock:
+                if node.name in self._patched:
+                    return
+                self._patched.add(node.name)
+            self._patch_executor.submit(self._patch_provider_id, node.name, node.get_id())
+            return
+
+        with self._patched_lock:
+            self._patched.discard(node.name)
+        if cached_node.provider_id != node.get_id():
+            raise KubeOperatorException("Node ProviderID is already set to an invalid value. " \
+                    "Did you change the provider type on the same cluster? Otherwise, verify that `provider-id` is not set in Kubelet config. " \
+                    f"Expected={node.get_id()} Value={cached_node.provider_id}")
+
+    def sync_status(self, nodes_provider_status: dict[str, ProviderStatus], write=True):
+        """Update the status of the managed nodes. Without `write`, the stale nodes are
+        not deleted and the provider ids are not set, like on a standby replica.
+        """
+        cached_nodes = self.informer.snapshot()
+        nodes_operator_status = self._get_status(cached_nodes)
         for n in self.managed_nodes:
             match nodes_provider_status.get(n.name), nodes_operator_status.get(n.name):
                 case [ProviderStatus.RUNNING, OperatorStatus.READY]:
@@ -81,29 +269,13 @@ class KubeOperator:
                 case [ProviderStatus.SHUTDOWN, OperatorStatus.READY]:
                     n.status = NodeStatus.DELETING
                 case [ProviderStatus.SHUTDOWN, OperatorStatus.DISCONNECTED]:
-                    self._delete_node(n)
+                    if write:
+                        self._delete_node(n)
                     n.status = NodeStatus.DELETING
                 case [ProviderStatus.SHUTDOWN, OperatorStatus.DELETED]:
                     n.status = NodeStatus.SHUTDOWN
                 case unsupported:
                     raise KubeOperatorException(f"Unsupported status. {unsupported}")
 
-            # TODO: We need to set ProviderID={n.get_id()}.
-            # It would be favorable to use an independant kubelet config file on each node to set the coresponding provider_id.
-            # For now, we loop on each node and check that the provider id is set correctly.
-            if n.status == NodeStatus.RUNNING:
-                try:
-                    node_api = self.api.read_node(n.name)
-                    if node_api.spec.provider_id is None:
-                        node_api.spec.provider_id = n.get_id()
-                        self.api.patch_node(n.name, node_api)
-                        logger.info(f"Set provider_id={n.get_id()} to node={n.name}")
-
-                    if node_api.spec.provider_id != n.get_id():
-                        raise KubeOperatorException("Node ProviderID is already set to an invalid value. " \
-                                "Did you change the provider type on the same cluster? Otherwise, verify that `provider-id` is not set in Kubelet config. " \
-                                f"Expected={n.get_id()} Value={node_api.spec.provider}")
-                except ApiException as e:
-                    logger.warning(f"Error reaching node={n.name}: {e}")
-                    pass
-
+            if write and n.status == NodeStatus.RUNNING:
+                self._check_provider_id(n, cached_nodes.get(n.name))
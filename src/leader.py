@@ -0,0 +1,154 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+import socket
+import time
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from kubernetes import client
+from kubernetes.client import V1Lease, V1LeaseSpec, V1ObjectMeta
+from kubernetes.client.exceptions import ApiException
+
+from kube_operator import load_kube_config
+
+NAMESPACE_FILE = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
+DEFAULT_NAMESPACE = "kube-system"
+
+
+class LeaderElectionException(Exception):
+    """Raised when something bad happened in the leader election"""
+
+def default_namespace() -> str:
+    """Namespace of the pod, from its service account"""
+    try:
+        with open(NAMESPACE_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return DEFAULT_NAMESPACE
+
+class LeaderElector:
+    """Elect a single writing replica with a coordination.k8s.io Lease, like client-go leaderelection.
+
+    The holder renews the lease every `retry_period`. The others take it over once it was
+    not renewed for `lease_duration`, measured on their own clock from the last change they
+    observed, so clock skew between nodes does not matter. The holder steps down by itself
+    when it could not renew for `renew_deadline`, before the lease expires for the others.
+    """
+    LEASE_DURATION = 15 # seconds
+    RENEW_DEADLINE = 10 # seconds
+    RETRY_PERIOD = 2 # seconds
+    REQUEST_TIMEOUT = 5 # seconds
+    HTTP_NOT_FOUND = 404
+    HTTP_CONFLICT = 409
+
+    def __init__(self, api: client.CoordinationV1Api, name: str, namespace=None, identity=None,
+                 lease_duration=LEASE_DURATION, renew_deadline=RENEW_DEADLINE, retry_period=RETRY_PERIOD,
+                 request_timeout=None):
+        if renew_deadline >= lease_duration:
+            raise LeaderElectionException(f"The renew deadline must be shorter than the lease duration: {renew_deadline=} {lease_duration=}")
+        if request_timeout is not None and request_timeout >= renew_deadline:
+            raise LeaderElectionException(f"The request timeout must be shorter than the renew deadline: {request_timeout=} {renew_deadline=}")
+        self.api = api
+        self.name = name
+        self.namespace = namespace or default_namespace()
+        # Pods use their name as hostname
+        self.identity = identity or socket.gethostname()
+        self.lease_duration = lease_duration
+        self.renew_deadline = renew_deadline
+        self.retry_period = retry_period
+        # A hung API call must not outlive the renew deadline, the replica would keep writing without a lease
+        self.request_timeout = request_timeout or min(self.REQUEST_TIMEOUT, renew_deadline / 2)
+        self._observed = None
+        self._observed_at = 0.0
+        self._renewed_at: Optional[float] = None
+
+    @staticmethod
+    def create_api() -> client.CoordinationV1Api:
+        load_kube_config()
+        return client.CoordinationV1Api()
+
+    def is_leader(self) -> bool:
+        return self._renewed_at is not None and time.monotonic() - self._renewed_at < self.renew_deadline
+
+    def try_acquire_or_renew(self) -> bool:
+        now = time.monotonic()
+        try:
+            lease = self.api.read_namespaced_lease(self.name, self.namespace, _request_timeout=self.request_timeout)
+        except ApiException as e:
+            if e.status != self.HTTP_NOT_FOUND:
+                raise
+            return self._create(now)
+
+        spec = lease.spec
+        record = (spec.holder_identity, spec.renew_time, lease.metadata.resource_version)
+        if record != self._observed:
+            self._observed, self._observed_at = record, now
+        duration = spec.lease_duration_seconds or self.lease_duration
+        if spec.holder_identity and spec.holder_identity != self.identity and now - self._observed_at < duration:
+            self._renewed_at = None
+            return False
+
+        utcnow = datetime.now(timezone.utc)
+        if spec.holder_identity != self.identity:
+            spec.acquire_time = utcnow
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.holder_identity = self.identity
+        spec.lease_duration_seconds = self.lease_duration
+        spec.renew_time = utcnow
+        try:
+            # The resourceVersion of the read makes the update fail if another replica wrote in between
+            self.api.replace_namespaced_lease(self.name, self.namespace, lease, _request_timeout=self.request_timeout)
+        except ApiException as e:
+            if e.status != self.HTTP_CONFLICT:
+                raise
+            self._renewed_at = None
+            return False
+        self._renewed_at = now
+        return True
+
+    def _create(self, now) -> bool:
+        utcnow = datetime.now(timezone.utc)
+        lease = V1Lease(metadata=V1ObjectMeta(name=self.name, namespace=self.namespace),
+                        spec=V1LeaseSpec(holder_identity=self.identity, lease_duration_seconds=self.lease_duration,
+                                         acquire_time=utcnow, renew_time=utcnow, lease_transitions=0))
+        try:
+            self.api.create_namespaced_lease(self.namespace, lease, _request_timeout=self.request_timeout)
+        except ApiException as e:
+            # Another replica created it first
+            if e.status != self.HTTP_CONFLICT:
+                raise
+            return False
+        self._renewed_at = now
+        return True
+
+    def release(self):
+        """Give the lease up so a standby takes over without waiting for it to expire"""
+        if self._renewed_at is None:
+            return
+        self._renewed_at = None
+        lease = self.api.read_namespaced_lease(self.name, self.namespace, _request_timeout=self.request_timeout)
+        if lease.spec.holder_identity != self.identity:
+            return
+        lease.spec.holder_identity = None
+        lease.spec.lease_duration_seconds = 1
+        lease.spec.renew_time = datetime.now(timezone.utc)
+        self.api.replace_namespaced_lease(self.name, self.namespace, lease, _request_timeout=self.request_timeout)
+        logger.info(f"Released lease {self.namespace}/{self.name}")
+
+    async def run(self, on_change: Callable[[bool], None]):
+        """Acquire or renew the lease every `retry_period`, call `on_change` when the leadership changes"""
+        loop = asyncio.get_running_loop()
+        leader = False
+        while True:
+            try:
+                await loop.run_in_executor(None, self.try_acquire_or_renew)
+            except Exception as e:
+                logger.warning(f"Could not update lease {self.namespace}/{self.name}: {e}")
+
+            if self.is_leader() != leader:
+                leader = not leader
+                logger.info(f"{self.identity} {'is now' if leader else 'is no longer'} the leader")
+                on_change(leader)
+            await asyncio.sleep(self.retry_period)
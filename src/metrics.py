@@ -0,0 +1,74 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from typing import Callable, List
+
+import grpc
+from prometheus_client import Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector, REGISTRY
+
+from node import NodeGroup
+
+METRICS_PORT = 8087
+
+RPC_LATENCY = Histogram("autoscaler_rpc_duration_seconds",
+                        "Duration of the CloudProvider gRPC handlers", ["method"])
+PROVIDER_CALL_LATENCY = Histogram("autoscaler_provider_call_duration_seconds",
+                                  "Duration of the calls to the provider backend (TFE API, minikube)", ["provider", "call"])
+SYNC_LATENCY = Histogram("autoscaler_sync_duration_seconds",
+                         "Duration of the provider and operator syncs", ["component"])
+
+
+class MetricsInterceptor(grpc.aio.ServerInterceptor):
+    """Time every unary gRPC handler"""
+    def __init__(self):
+        self._handlers = {}
+
+    async def intercept_service(self, continuation, handler_call_details):
+        method = handler_call_details.method
+        if method in self._handlers:
+            return self._handlers[method]
+
+        handler = await continuation(handler_call_details)
+        if handler is not None and handler.unary_unary is not None:
+            handler = self._timed_handler(handler, method.rsplit("/", 1)[-1])
+        self._handlers[method] = handler
+        return handler
+
+    @staticmethod
+    def _timed_handler(handler, name):
+        behavior = handler.unary_unary
+        histogram = RPC_LATENCY.labels(name)
+
+        async def timed_behavior(request, context):
+            with histogram.time():
+                return await behavior(request, context)
+
+        return grpc.unary_unary_rpc_method_handler(
+                timed_behavior,
+                request_deserializer=handler.request_deserializer,
+                response_serializer=handler.response_serializer)
+
+
+class NodeCountCollector(Collector):
+    """Count the managed nodes per group, status and flag when scraped"""
+    def __init__(self, node_groups: Callable[[], List[NodeGroup]]):
+        self.node_groups = node_groups
+
+    def collect(self):
+        nodes = GaugeMetricFamily("autoscaler_nodes", "Managed nodes per group and status", labels=["group", "status"])
+        flags = GaugeMetricFamily("autoscaler_node_flags", "Managed nodes per group and pending action", labels=["group", "flag"])
+        for ng in self.node_groups():
+            for status, count in ng.count_by_status().items():
+                nodes.add_metric([ng.id, status.value], count)
+            for flag, count in ng.count_by_flag().items():
+                flags.add_metric([ng.id, flag.value], count)
+        yield nodes
+        yield flags
+
+
+def start_metrics_server(port: int, node_groups: Callable[[], List[NodeGroup]]):
+    REGISTRY.register(NodeCountCollector(node_groups))
+    start_http_server(port)
+    logger.info(f"Serving metrics on port {port}")
@@ -3,9 +3,11 @@ logger = logging.getLogger(__name__)
 
 from protos.k8s.io.apimachinery.pkg.api.resource.generated_pb2 import Quantity
 
+import itertools
+import threading
 from typing import Optional
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import StrEnum, auto
 
 from protos.externalgrpc_pb2 import NodeGroup as NodeGroupProtobuf
@@ -13,6 +15,9 @@ from protos.externalgrpc_pb2 import Instance as InstaceProtobuf
 from protos.externalgrpc_pb2 import InstanceStatus
 from protos.k8s.io.api.core.v1.generated_pb2 import NodeStatus as K8SNodeStatus
 
+# Shared by all node groups, next() on it is atomic so syncs and RPCs can bump it from any thread
+_generation = itertools.count(1)
+
 class NodeStatus(StrEnum):
     RUNNING = auto()
     CREATING = auto()
@@ -42,12 +47,27 @@ class Specs:
         return K8SNodeStatus(capacity=capacity, allocatable=capacity)
 
 
-@dataclass
+# Slots drop the per-instance __dict__, large inventories preallocate tens of thousands of nodes
+@dataclass(slots=True)
 class Node:
     name: str
     status: NodeStatus
     provider_id: str
     flag: Optional[ActionFlag] = None
+    group: Optional["NodeGroup"] = field(default=None, repr=False, compare=False)
+
+    WATCHED_ATTRIBUTES = ("status", "flag")
+
+    def __setattr__(self, name, value):
+        if name not in self.WATCHED_ATTRIBUTES:
+            return object.__setattr__(self, name, value)
+
+        old = getattr(self, name, None)
+        object.__setattr__(self, name, value)
+        # `group` is not set yet while the dataclass __init__ runs
+        group = getattr(self, "group", None)
+        if group is not None and old != value:
+            group._node_changed(self, name, old)
 
     def get_id(self) -> str:
         return f"{self.provider_id}://{self.name}"
@@ -74,10 +94,72 @@ class Node:
 class NodeGroup:
     MIN_SIZE = 0
 
-    def __init__(self, nodes=[], id='', specs: Specs = Specs(0, 0, 0)):
-        self.nodes = nodes
+    def __init__(self, nodes=None, id='', specs: Specs = Specs(0, 0, 0)):
+        self.nodes = []
+        self._nodes_by_name = {}
         self.id = id
         self.specs = specs
+        # Bumped every time the group or the status or flag of one of its nodes changes
+        self.generation = next(_generation)
+        self._protobuf = None
+        # Membership of the nodes per status and per flag, kept up to date by _node_changed.
+        # Syncs change the nodes from another thread, the lock protects the iterations.
+        self._nodes_by_status: dict[NodeStatus, dict[str, Node]] = {status: {} for status in NodeStatus}
+        self._nodes_by_flag: dict[ActionFlag, dict[str, Node]] = {flag: {} for flag in ActionFlag}
+        # Flags handed to the provider, until the operator sync updates the status of the nodes
+        self._applying: dict[str, tuple[Node, ActionFlag]] = {}
+        self._lock = threading.RLock()
+        for n in nodes or []:
+            self.add_node(n)
+
+    def add_node(self, node: Node):
+        with self._lock:
+            self.nodes.append(node)
+            self._nodes_by_name[node.name] = node
+            self._nodes_by_status[node.status][node.name] = node
+            if node.flag is not None:
+                self._nodes_by_flag[node.flag][node.name] = node
+            node.group = self
+        self.generation = next(_generation)
+
+    def _node_changed(self, node: Node, attribute: str, old):
+        with self._lock:
+            if attribute == "status":
+                self._nodes_by_status[old].pop(node.name, None)
+                self._nodes_by_status[node.status][node.name] = node
+            else:
+                if old is not None:
+                    self._nodes_by_flag[old].pop(node.name, None)
+                if node.flag is not None:
+                    self._nodes_by_flag[node.flag][node.name] = node
+        self.generation = next(_generation)
+
+    def begin_apply(self):
+        """Remember the pending flags before the provider applies and clears them.
+        Until end_apply, the nodes of the cleared flags keep counting in the target size
+        while their status is not updated yet.
+        """
+        with self._lock:
+            for flag, nodes in self._nodes_by_flag.items():
+                for name, n in nodes.items():
+                    self._applying[name] = (n, flag)
+
+    def end_apply(self):
+        """The operator sync updated the status of the applied nodes"""
+        with self._lock:
+            if not self._applying:
+                return
+            self._applying = {}
+        self.generation = next(_generation)
+
+    def count_by_status(self) -> dict[NodeStatus, int]:
+        return {status: len(nodes) for status, nodes in self._nodes_by_status.items()}
+
+    def count_by_flag(self) -> dict[ActionFlag, int]:
+        return {flag: len(nodes) for flag, nodes in self._nodes_by_flag.items()}
+
+    def get_node(self, name) -> Optional[Node]:
+        return self._nodes_by_name.get(name)
 
     def max_size(self) -> int:
         return len(self.nodes)
@@ -86,16 +168,33 @@ class NodeGroup:
         return self.MIN_SIZE
 
     def target_size(self) -> int:
-        return len(self.get_running_nodes())
+        # Requested starts count in the target, requested deletions do not.
+        # Changes applied by the provider count until their node status is updated, each node once.
+        active = [NodeStatus.RUNNING, NodeStatus.CREATING]
+        with self._lock:
+            size = len(self._nodes_by_status[NodeStatus.RUNNING]) + len(self._nodes_by_status[NodeStatus.CREATING])
+            applied: dict[ActionFlag, list[Node]] = {flag: [] for flag in ActionFlag}
+            for n, flag in self._applying.values():
+                if n.flag is None:
+                    applied[flag].append(n)
+            for n in itertools.chain(self._nodes_by_flag[ActionFlag.TO_START].values(), applied[ActionFlag.TO_START]):
+                if n.status not in active:
+                    size += 1
+            for n in itertools.chain(self._nodes_by_flag[ActionFlag.TO_DELETE].values(), applied[ActionFlag.TO_DELETE]):
+                if n.status in active:
+                    size -= 1
+        return size
 
     def debug(self) -> str:
         return f"{self.id=}, {self.min_size()=}, {self.max_size()=}, {self.target_size()=}"
 
     def _start_available_node(self):
-        for n in self.nodes:
-            if n.status in [NodeStatus.SHUTDOWN, NodeStatus.DELETING] and n.flag is None:
-                n.flag = ActionFlag.TO_START
-                return n
+        with self._lock:
+            for status in [NodeStatus.SHUTDOWN, NodeStatus.DELETING]:
+                for n in self._nodes_by_status[status].values():
+                    if n.flag is None:
+                        n.flag = ActionFlag.TO_START
+                        return n
 
     def increase_size(self, delta):
         nodes = []
@@ -109,15 +208,35 @@ class NodeGroup:
         logger.debug(f"TO_START: {delta=} {nodes}")
 
 
+    def decrease_target_size(self, delta):
+        """Cancel `-delta` requested nodes that are not running yet.
+        Starts not applied by the provider are dropped first, then CREATING nodes
+        that have not registered in Kubernetes are stopped with the next changes.
+        """
+        if delta >= 0:
+            raise Exception(f"Target size decrease must be negative: {delta=}")
+
+        with self._lock:
+            pending = list(self._nodes_by_flag[ActionFlag.TO_START].values())
+            creating = [n for n in self._nodes_by_status[NodeStatus.CREATING].values() if n.flag is None]
+            if -delta > len(pending) + len(creating):
+                raise Exception(f"Cannot decrease target size by {-delta}, only {len(pending) + len(creating)} nodes are not running yet")
+
+            nodes = (pending + creating)[:-delta]
+            for n in nodes:
+                n.flag = None if n.flag == ActionFlag.TO_START else ActionFlag.TO_DELETE
+
+        logger.debug(f"DecreaseTargetSize: {delta=} {nodes}")
+
     def get_running_nodes(self, include_deleting=False):
         nodes = []
         flags = [NodeStatus.RUNNING, NodeStatus.CREATING]
         if include_deleting:
             flags.append(NodeStatus.DELETING)
 
-        for n in self.nodes:
-            if n.status in flags:
-                nodes.append(n)
+        with self._lock:
+            for status in flags:
+                nodes.extend(self._nodes_by_status[status].values())
         return nodes
 
 
@@ -129,12 +248,17 @@ class NodeGroup:
 
     def _get_nodes_by_name(self, names):
         nodes = []
-        for n in self.nodes:
-            if n.name in names:
+        for name in names:
+            n = self._nodes_by_name.get(name)
+            if n is not None:
                 nodes.append(n)
         return nodes
 
     def to_protobuf(self):
-        return NodeGroupProtobuf(id=self.id, minSize=self.min_size(), maxSize=self.max_size(), debug=self.debug())
+        generation = self.generation
+        if self._protobuf is None or self._protobuf[0] != generation:
+            protobuf = NodeGroupProtobuf(id=self.id, minSize=self.min_size(), maxSize=self.max_size(), debug=self.debug())
+            self._protobuf = (generation, protobuf)
+        return self._protobuf[1]
 
 
@@ -1,7 +1,9 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from typing import List
+import asyncio
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Union
 from enum import StrEnum, auto
 
 from node import ActionFlag, Node
@@ -14,15 +16,43 @@ class ProviderStatus(StrEnum):
     SHUTDOWN = auto()
 
 class ProviderBase:
+    # Dataclass of the provider section in config.yaml, with the provider id as `id` class attribute
+    config_schema: type
+    # The nodes join a cluster exposed by kube_client() instead of the cluster the server runs in
+    OWN_CLUSTER = False
+
     def __init__(self, managed_nodes: List[Node]):
         self.managed_nodes = managed_nodes
 
+    def kube_client(self):
+        """CoreV1Api and watch factory of the cluster the nodes join, None for the cluster the server runs in"""
+        return None
+
+    def set_managed_nodes(self, managed_nodes: List[Node]):
+        """Replace the managed nodes after a config reload, the list is swapped in one assignment"""
+        self.managed_nodes = managed_nodes
+
+    def get_state(self) -> dict:
+        """Provider state to persist across restarts, must be JSON serializable"""
+        return {}
+
+    def set_state(self, state: dict):
+        pass
+
     def get_nodes_status(self) -> dict[str, ProviderStatus]:
         raise NotImplementedError
 
-    def sync_status(self) -> dict[str, ProviderStatus]:
+    def sync_status(self, apply_changes: Union[bool, Callable[[], bool]] = True) -> dict[str, ProviderStatus]:
+        """Return the status of the managed nodes. The flagged changes are applied first,
+        unless `apply_changes` is False: they are then kept for a later sync.
+        A callable `apply_changes` is checked once the status is read, right before the changes are applied.
+        """
         raise NotImplementedError
 
+    @staticmethod
+    def _should_apply(apply_changes: Union[bool, Callable[[], bool]]) -> bool:
+        return apply_changes() if callable(apply_changes) else apply_changes
+
     def _get_changes(self, nodes_state: dict[str, ProviderStatus]):
         nodes_to_start = []
         nodes_to_stop = []
@@ -44,3 +74,58 @@ class ProviderBase:
                     raise ProviderBaseException(f"Unknow provider state for the node={n.name}")
         return nodes_to_start, nodes_to_stop
 
+
+class AsyncProviderBase(ProviderBase):
+    """Provider whose calls are coroutines run on the event loop of the server.
+    The constructor must not do any I/O, the startup calls go in `start`.
+    The calls may be cancelled, e.g. on shutdown: the I/O in flight must then be aborted.
+    """
+
+    async def start(self):
+        """Startup calls, e.g. credentials check, awaited before the first sync"""
+
+    async def close(self):
+        """Release the resources bound to the event loop, e.g. HTTP sessions"""
+
+    async def get_nodes_status(self) -> dict[str, ProviderStatus]:
+        raise NotImplementedError
+
+    async def sync_status(self, apply_changes=True) -> dict[str, ProviderStatus]:
+        """See ProviderBase.sync_status"""
+        raise NotImplementedError
+
+class SyncProviderAdapter(AsyncProviderBase):
+    """Async contract over a blocking provider, its calls run in `executor`"""
+
+    def __init__(self, provider: ProviderBase, executor: Optional[Executor] = None):
+        self.provider = provider
+        self.executor = executor
+
+    @property
+    def managed_nodes(self) -> List[Node]:
+        return self.provider.managed_nodes
+
+    def kube_client(self):
+        return self.provider.kube_client()
+
+    def set_managed_nodes(self, managed_nodes: List[Node]):
+        self.provider.set_managed_nodes(managed_nodes)
+
+    def get_state(self) -> dict:
+        return self.provider.get_state()
+
+    def set_state(self, state: dict):
+        self.provider.set_state(state)
+
+    async def get_nodes_status(self) -> dict[str, ProviderStatus]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.provider.get_nodes_status)
+
+    async def sync_status(self, apply_changes=True) -> dict[str, ProviderStatus]:
+        return await asyncio.get_running_loop().run_in_executor(
+                self.executor, lambda: self.provider.sync_status(apply_changes=apply_changes))
+
+def as_async(provider: ProviderBase, executor: Optional[Executor] = None) -> AsyncProviderBase:
+    """The provider itself when it is async, otherwise wrapped in a SyncProviderAdapter"""
+    if isinstance(provider, AsyncProviderBase):
+        return provider
+    return SyncProviderAdapter(provider, executor)
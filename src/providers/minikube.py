@@ -4,28 +4,53 @@ logger = logging.getLogger(__name__)
 
 from node import Node
 
+import asyncio
+from asyncio.subprocess import PIPE
+from dataclasses import dataclass
 from typing import List
 import re
 import json
-from providers.base import ProviderBase, ProviderBaseException, ProviderStatus
+from providers.base import AsyncProviderBase, ProviderBaseException, ProviderStatus
+from metrics import PROVIDER_CALL_LATENCY
 
 class MinikubeOp(StrEnum):
     START = "start"
     STOP = "stop"
 
-from subprocess import run, PIPE
-
 class MinikubeProviderException(ProviderBaseException):
     """Raised when something bad happened in autoscale main"""
 
-class MinikubeProvider(ProviderBase):
+@dataclass
+class MinikubeConfig:
+    parallelism: int = 4
+    id = "minikube"
+
+class MinikubeProvider(AsyncProviderBase):
+    config_schema = MinikubeConfig
+
+    def __init__(self, managed_nodes: List[Node], config: MinikubeConfig):
+        super().__init__(managed_nodes)
+        self.parallelism = config.parallelism
 
-    def get_nodes_status(self) -> dict[str, ProviderStatus]:
+    @staticmethod
+    async def _run(*args) -> tuple[int, bytes, bytes]:
+        """Run minikube without blocking the event loop, the process is killed when the call is cancelled"""
+        proc = await asyncio.create_subprocess_exec("minikube", *args, stdout=PIPE, stderr=PIPE)
+        try:
+            stdout, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            # Drain the pipes so their transports are closed with the process
+            await proc.communicate()
+            raise
+        return proc.returncode, stdout, stderr
+
+    async def get_nodes_status(self) -> dict[str, ProviderStatus]:
         nodes = {n.name: ProviderStatus.SHUTDOWN for n in self.managed_nodes}
 
-        minikube_output = run(["minikube", "status", "-o=json"],
-                  stderr=PIPE, stdout=PIPE)
-        node_status = json.loads(minikube_output.stdout.decode())
+        with PROVIDER_CALL_LATENCY.labels("minikube", "status").time():
+            _, stdout, _ = await self._run("status", "-o=json")
+        node_status = json.loads(stdout.decode())
 
         for n in node_status:
             name = n['Name']
@@ -34,21 +59,42 @@ class MinikubeProvider(ProviderBase):
                 nodes[name] = ProviderStatus.RUNNING
         return nodes
 
-    def _apply_op(self, nodes: list[Node], op: MinikubeOp):
-        for n in nodes:
-            run(["minikube", "node", op.value, n.name],
-                      stderr=PIPE, stdout=PIPE)
+    async def _run_op(self, node: Node, op: MinikubeOp, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            with PROVIDER_CALL_LATENCY.labels("minikube", op.value).time():
+                return await self._run("node", op.value, node.name)
+
+    async def _apply_ops(self, ops: list[tuple[Node, MinikubeOp]], nodes_status: dict[str, ProviderStatus]):
+        """Run minikube operations concurrently, at most `parallelism` at a time.
+        The flag of a node is only cleared on success, failed operations are retried on next sync.
+        """
+        semaphore = asyncio.Semaphore(self.parallelism)
+        # An error in one operation cancels the others, which kills their processes
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tasks = [tg.create_task(self._run_op(n, op, semaphore)) for n, op in ops]
+        except ExceptionGroup as e:
+            raise e.exceptions[0]
+
+        for (n, op), task in zip(ops, tasks):
+            returncode, _, stderr = task.result()
+            if returncode != 0:
+                logger.warning(f"    Minikube {op} {n.name} failed ({returncode=}): {stderr.decode().strip()}")
+                continue
             logger.info(f"    Minikube {op} {n}")
             n.flag = None
+            nodes_status[n.name] = ProviderStatus.RUNNING if op == MinikubeOp.START else ProviderStatus.SHUTDOWN
 
-    def sync_status(self) -> dict[str, ProviderStatus]:
-        nodes_status = self.get_nodes_status()
+    async def sync_status(self, apply_changes=True) -> dict[str, ProviderStatus]:
+        nodes_status = await self.get_nodes_status()
+        if not self._should_apply(apply_changes):
+            return nodes_status
         nodes_to_start, nodes_to_stop = self._get_changes(nodes_status)
 
         if len(nodes_to_start) > 0 or len(nodes_to_stop) > 0:
             logger.info(f"Changes to apply:")
-            self._apply_op(nodes_to_start, MinikubeOp.START)
-            self._apply_op(nodes_to_stop, MinikubeOp.STOP)
+            ops = [(n, MinikubeOp.START) for n in nodes_to_start] + [(n, MinikubeOp.STOP) for n in nodes_to_stop]
+            await self._apply_ops(ops, nodes_status)
         else:
             logger.debug(f"No changes to apply")
 
@@ -0,0 +1,28 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import importlib
+
+from providers.base import ProviderBase, ProviderBaseException
+
+# Provider id in config.yaml -> "module.Class". The module is only imported when the provider is selected,
+# so the dependencies of the other providers (aiohttp, minikube CLI helpers) are never loaded.
+PROVIDERS: dict[str, str] = {
+    "tfe": "providers.tfe.TFEProvider",
+    "minikube": "providers.minikube.MinikubeProvider",
+    "simulated": "providers.simulated.SimulatedProvider",
+}
+
+
+def register_provider(id: str, path: str):
+    """Make the provider class at `path` ("module.Class") selectable as `id` in config.yaml"""
+    PROVIDERS[id] = path
+
+
+def load_provider(id: str) -> type[ProviderBase]:
+    path = PROVIDERS.get(id)
+    if path is None:
+        raise ProviderBaseException(f"Unknown provider {id}, available providers: {', '.join(PROVIDERS)}")
+    module, class_name = path.rsplit(".", 1)
+    logger.debug(f"Loading provider {id} from {module}")
+    return getattr(importlib.import_module(module), class_name)
@@ -0,0 +1,271 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import StrEnum, auto
+from typing import List, Optional
+
+from kubernetes.client import V1Node, V1NodeCondition, V1NodeList, V1NodeSpec, V1NodeStatus, V1ListMeta, V1ObjectMeta
+from kubernetes.client.exceptions import ApiException
+
+from node import Node
+from providers.base import ProviderBase, ProviderBaseException, ProviderStatus
+
+
+class SimulatedProviderException(ProviderBaseException):
+    """Raised when something bad happened in the simulated provider"""
+
+@dataclass
+class SimulatedConfig:
+    # Delays in seconds: a constant, {min, max} (uniform) or {mean, stddev} (normal)
+    boot_delay: float | dict = field(default_factory=lambda: {"min": 30, "max": 90})
+    register_delay: float | dict = field(default_factory=lambda: {"min": 5, "max": 20})
+    shutdown_delay: float | dict = 10
+    failure_rate: float = 0
+    capacity: Optional[int] = None
+    initial_running: int = 0
+    seed: Optional[int] = None
+    id = "simulated"
+
+class InstanceState(StrEnum):
+    SHUTDOWN = auto()
+    BOOTING = auto()
+    RUNNING = auto()
+    STOPPING = auto()
+
+@dataclass
+class SimulatedInstance:
+    name: str
+    state: InstanceState = InstanceState.SHUTDOWN
+    until: float = 0 # end of the boot or shutdown
+    ready_at: float = 0 # the node turns Ready in Kubernetes
+    # Kubernetes side of the instance
+    registered: bool = False
+    provider_id: Optional[str] = None
+
+
+def sample_delay(distribution, rng: random.Random) -> float:
+    """Draw a delay in seconds from a constant, `{min, max}` (uniform) or `{mean, stddev}` (normal)"""
+    match distribution:
+        case int() | float():
+            return float(distribution)
+        case {"min": low, "max": high}:
+            return rng.uniform(low, high)
+        case {"mean": mean, "stddev": stddev}:
+            return max(0.0, rng.gauss(mean, stddev))
+        case _:
+            raise SimulatedProviderException(f"Invalid delay distribution: {distribution}")
+
+
+class SimulatedCloud:
+    """In-memory instances and the Kubernetes nodes they register.
+
+    Booted instances join the cluster as NotReady nodes, then turn Ready after
+    `register_delay`. Stopped instances stay in the cluster as Unknown nodes
+    until deleted, like a kubelet that stopped reporting. The object implements
+    the subset of CoreV1Api used by KubeOperator.
+    """
+    EVENT_HISTORY = 10000
+    WATCH_POLL_INTERVAL = 0.5 # seconds
+
+    def __init__(self, names: List[str], config: SimulatedConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.instances = {name: SimulatedInstance(name) for name in names}
+        self._lock = threading.Lock()
+        now = time.monotonic()
+        for name in names[:config.initial_running]:
+            instance = self.instances[name]
+            instance.state = InstanceState.RUNNING
+            instance.ready_at = now
+            instance.registered = True
+
+        self._resource_version = 0
+        self._events = deque(maxlen=self.EVENT_HISTORY)
+        self._nodes = {}
+        self._advance()
+
+    def _active(self) -> int:
+        return sum(1 for i in self.instances.values() if i.state in (InstanceState.BOOTING, InstanceState.RUNNING))
+
+    def start(self, name) -> bool:
+        with self._lock:
+            self._advance()
+            if self.config.capacity is not None and self._active() >= self.config.capacity:
+                return False
+            instance = self.instances[name]
+            instance.state = InstanceState.BOOTING
+            instance.until = time.monotonic() + sample_delay(self.config.boot_delay, self.rng)
+            return True
+
+    def stop(self, name):
+        with self._lock:
+            self._advance()
+            instance = self.instances[name]
+            instance.state = InstanceState.STOPPING
+            instance.until = time.monotonic() + sample_delay(self.config.shutdown_delay, self.rng)
+
+    def add_instances(self, names: List[str]):
+        with self._lock:
+            for name in names:
+                self.instances.setdefault(name, SimulatedInstance(name))
+
+    def status(self) -> dict[str, InstanceState]:
+        with self._lock:
+            self._advance()
+            return {name: i.state for name, i in self.instances.items()}
+
+    def _node_condition(self, instance: SimulatedInstance, now: float) -> Optional[str]:
+        """Ready condition of the Kubernetes node of an instance, None when not in the cluster"""
+        if not instance.registered:
+            return None
+        if instance.state != InstanceState.RUNNING:
+            return "Unknown"
+        if now < instance.ready_at:
+            return "False"
+        return "True"
+
+    def _advance(self):
+        """Move the instances and nodes to their current state and record the node events.
+        Must be called with the lock held, or before the cloud is shared.
+        """
+        now = time.monotonic()
+        for instance in self.instances.values():
+            if instance.state == InstanceState.BOOTING and now >= instance.until:
+                if self.rng.random() < self.config.failure_rate:
+                    logger.info(f"Simulated boot failure of {instance.name}")
+                    instance.state = InstanceState.SHUTDOWN
+                else:
+                    instance.state = InstanceState.RUNNING
+                    instance.ready_at = now + sample_delay(self.config.register_delay, self.rng)
+                    instance.registered = True
+            elif instance.state == InstanceState.STOPPING and now >= instance.until:
+                instance.state = InstanceState.SHUTDOWN
+
+        for instance in self.instances.values():
+            condition = self._node_condition(instance, now)
+            current = None if condition is None else (condition, instance.provider_id)
+            previous = self._nodes.get(instance.name)
+            if current == previous:
+                continue
+            if current is None:
+                del self._nodes[instance.name]
+                self._record("DELETED", instance.name, previous)
+            else:
+                self._nodes[instance.name] = current
+                self._record("ADDED" if previous is None else "MODIFIED", instance.name, current)
+
+    def _record(self, event_type, name, node):
+        self._resource_version += 1
+        self._events.append((self._resource_version, event_type, self._to_v1_node(name, node)))
+
+    def _to_v1_node(self, name, node) -> V1Node:
+        condition, provider_id = node
+        return V1Node(
+                metadata=V1ObjectMeta(name=name, resource_version=str(self._resource_version)),
+                spec=V1NodeSpec(provider_id=provider_id),
+                status=V1NodeStatus(conditions=[V1NodeCondition(type="Ready", status=condition)]))
+
+    def events_since(self, resource_version: int) -> list:
+        with self._lock:
+            self._advance()
+            if self._events and resource_version < self._events[0][0] - 1:
+                raise ApiException(status=410, reason="Expired: too old resource version")
+            return [e for e in self._events if e[0] > resource_version]
+
+    def list_node(self, **kwargs) -> V1NodeList:
+        with self._lock:
+            self._advance()
+            items = [self._to_v1_node(name, node) for name, node in self._nodes.items()]
+            return V1NodeList(items=items, metadata=V1ListMeta(resource_version=str(self._resource_version)))
+
+    def patch_node(self, name, body, **kwargs):
+        with self._lock:
+            instance = self.instances.get(name)
+            if instance is None or not instance.registered:
+                raise ApiException(status=404, reason=f"node {name} not found")
+            instance.provider_id = body["spec"]["providerID"]
+            self._advance()
+
+    def delete_node(self, name, **kwargs):
+        with self._lock:
+            instance = self.instances.get(name)
+            if instance is None or not instance.registered:
+                raise ApiException(status=404, reason=f"node {name} not found")
+            instance.registered = False
+            instance.provider_id = None
+            self._advance()
+
+    def watch(self) -> "SimulatedWatch":
+        return SimulatedWatch(self)
+
+
+class SimulatedWatch:
+    """Stream the node events of a SimulatedCloud like kubernetes.watch.Watch"""
+    def __init__(self, cloud: SimulatedCloud):
+        self.cloud = cloud
+        self.resource_version = None
+        self._stop = threading.Event()
+
+    def stream(self, func, resource_version=None, timeout_seconds=None, **kwargs):
+        self.resource_version = resource_version
+        deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+        while not self._stop.is_set() and (deadline is None or time.monotonic() < deadline):
+            for resource_version, event_type, node in self.cloud.events_since(int(self.resource_version or 0)):
+                self.resource_version = str(resource_version)
+                yield {"type": event_type, "object": node}
+            self._stop.wait(self.cloud.WATCH_POLL_INTERVAL)
+
+    def stop(self):
+        self._stop.set()
+
+
+class SimulatedProvider(ProviderBase):
+    config_schema = SimulatedConfig
+    OWN_CLUSTER = True
+
+    def __init__(self, managed_nodes: List[Node], config: SimulatedConfig):
+        super().__init__(managed_nodes)
+        self.cloud = SimulatedCloud([n.name for n in managed_nodes], config)
+
+    def kube_client(self):
+        # The simulated instances register in an in-memory cluster
+        return self.cloud, self.cloud.watch
+
+    def set_managed_nodes(self, managed_nodes: List[Node]):
+        # Instances removed from the config stay in the cloud, unmanaged
+        self.cloud.add_instances([n.name for n in managed_nodes])
+        super().set_managed_nodes(managed_nodes)
+
+    def get_nodes_status(self) -> dict[str, ProviderStatus]:
+        nodes = {}
+        for name, state in self.cloud.status().items():
+            # Like the TFE pool, an instance is RUNNING as soon as the provider accepted to start it
+            if state in (InstanceState.BOOTING, InstanceState.RUNNING):
+                nodes[name] = ProviderStatus.RUNNING
+            else:
+                nodes[name] = ProviderStatus.SHUTDOWN
+        return nodes
+
+    def sync_status(self, apply_changes=True) -> dict[str, ProviderStatus]:
+        nodes_status = self.get_nodes_status()
+        if not self._should_apply(apply_changes):
+            return nodes_status
+        nodes_to_start, nodes_to_stop = self._get_changes(nodes_status)
+
+        for n in nodes_to_start:
+            if self.cloud.start(n.name):
+                n.flag = None
+                nodes_status[n.name] = ProviderStatus.RUNNING
+            else:
+                logger.warning(f"Simulated capacity reached, node={n.name} will be started on next sync")
+        for n in nodes_to_stop:
+            self.cloud.stop(n.name)
+            n.flag = None
+            nodes_status[n.name] = ProviderStatus.SHUTDOWN
+
+        return nodes_status
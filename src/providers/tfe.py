@@ -1,44 +1,107 @@
-
-from requests.exceptions import Timeout
+import asyncio
+import contextlib
 from enum import StrEnum
 import logging
+import time
 
 from node import Node, NodeStatus
 logger = logging.getLogger(__name__)
 
-from typing import List, Tuple
-from providers.base import ProviderBase, ProviderBaseException, ProviderStatus
-from config import Config
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from providers.base import AsyncProviderBase, ProviderBaseException, ProviderStatus
 
-from providers.tfe_lib import TFECLient
+from providers.tfe_lib import API_URL, HTTP_NOT_FOUND, TFEAPIError, TFECLient, TFEConnectionError
 
 class TFEProviderException(ProviderBaseException):
     """Raised when something bad happened in autoscale main"""
 
-class TFEProvider(ProviderBase):
+@dataclass
+class TFEConfig:
+    token: str
+    workspace: str
+    timeout: float = 5
+    retries: int = 3
+    backoff: float = 0.5
+    api_url: Optional[str] = None
+    cache_ttl: float = 5
+    confirm_timeout: float = 600
+    id = "tfe"
+
+class TFEProvider(AsyncProviderBase):
+    config_schema = TFEConfig
     POOL_VAR = "pool"
-
-    def __init__(self, managed_nodes: List[Node], config: Config.TFE):
+    # Run states after which the workspace accepts a new run without stacking it in the queue
+    RUN_FINAL_STATUS = frozenset([
+        "applied", "planned_and_finished", "planned_and_saved",
+        "discarded", "errored", "canceled", "force_canceled",
+    ])
+    # Run states that wait for a confirmation or a policy override when auto-apply is off.
+    # They are also passed through with auto-apply, the run is only given up after `confirm_timeout`.
+    RUN_WAITING_STATUS = frozenset([
+        "planned", "cost_estimated", "policy_checked", "policy_override",
+        "policy_soft_failed", "post_plan_completed",
+    ])
+
+    def __init__(self, managed_nodes: List[Node], config: TFEConfig):
         super().__init__(managed_nodes)
-        self.client = TFECLient(config.token, config.workspace)
-        self.var_id, _ = self._fetch_pool()
-
-    def get_nodes_status(self) -> dict[str, ProviderStatus]:
+        self.client = TFECLient(config.token, config.workspace, timeout=config.timeout,
+                                retries=config.retries, backoff=config.backoff,
+                                api_url=config.api_url or API_URL, cache_ttl=config.cache_ttl)
+        self.var_id = None
+        # Content of the pool variable at the last read
+        self.pool: set[str] = set()
+        self.run_id = None
+        self.confirm_timeout = config.confirm_timeout
+        # Since when the run waits for a confirmation, monotonic
+        self._run_waiting_since: Optional[float] = None
+        # Pool update and run creation in flight, shielded from the cancellation of the sync
+        self._applying: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # The workspace check and the pool lookup do not depend on each other
+        validation, pool = await asyncio.gather(self.client.validate(), self._fetch_pool(), return_exceptions=True)
+        # An invalid token or workspace explains a failed lookup, report it first
+        for result in [validation, pool]:
+            if isinstance(result, BaseException):
+                raise result
+        self.var_id, _ = pool
+
+    async def close(self):
+        # The session is closed once the pool update and its run are done
+        if self._applying is not None:
+            with contextlib.suppress(Exception):
+                await self._applying
+        await self.client.close()
+
+    def get_state(self) -> dict:
+        return {"run_id": self.run_id}
+
+    def set_state(self, state: dict):
+        # A run queued before the restart must finish before the next changes are applied
+        self.run_id = state.get("run_id")
+        if self.run_id is not None:
+            logger.info(f"Restored run {self.run_id}")
+
+    async def get_nodes_status(self) -> dict[str, ProviderStatus]:
         nodes = {n.name: ProviderStatus.SHUTDOWN for n in self.managed_nodes}
 
-        _, running_nodes = self._fetch_pool()
+        self.var_id, self.pool = await self._fetch_pool()
+        running_nodes = self.pool
         for name in running_nodes:
             if name in nodes.keys():
                 nodes[name] = ProviderStatus.RUNNING
         return nodes
 
-    def _fetch_pool(self) -> Tuple[str, set[str]]:
+    async def _fetch_pool(self) -> Tuple[str, set[str]]:
         """Retrieve id and content of POOL variable from Terraform cloud
         """
         try:
-            tfe_var = self.client.fetch_variable(self.POOL_VAR)
-        except Timeout as exc:
-            raise TFEProviderException("Connection to Terraform cloud timeout (5s)") from exc
+            tfe_var = await self.client.fetch_variable(self.POOL_VAR, self.var_id)
+        except TFEConnectionError as exc:
+            raise TFEProviderException(f"Connection to Terraform cloud failed: {exc}") from exc
+        except TFEAPIError as exc:
+            raise TFEProviderException(f'Could not read the "{self.POOL_VAR}" variable: {exc}') from exc
 
         if tfe_var is None:
             raise TFEProviderException(
@@ -51,33 +114,121 @@ class TFEProvider(ProviderBase):
             return tfe_var["id"], set(tfe_var["value"])
         return tfe_var["id"], set()
 
-    def sync_status(self) -> dict[str, ProviderStatus]:
-        nodes_status = self.get_nodes_status()
-        nodes_to_start, nodes_to_stop = self._get_changes(nodes_status)
-
-        if len(nodes_to_start) > 0 or len(nodes_to_stop) > 0:
-            new_pool = set()
-            for name, status in nodes_status.items():
-                if status == ProviderStatus.RUNNING:
-                    new_pool.add(name)
-            new_pool |= set([n.name for n in nodes_to_start])
-            new_pool -= set([n.name for n in nodes_to_stop])
-            logger.debug(f"Changes to apply: {new_pool=}")
-
-            try:
-                self.client.update_variable(self.var_id, list(new_pool))
-            except Timeout as exc:
-                raise TFEProviderException(
-                    "Connection to Terraform cloud timeout (5s)"
-                ) from exc
+    async def _update_pool(self, pool: set[str]):
+        try:
+            resp = await self.client.update_variable(self.var_id, list(pool))
+        except TFEConnectionError as exc:
+            raise TFEProviderException(f"Connection to Terraform cloud failed: {exc}") from exc
+        if not resp.ok:
+            raise TFEProviderException(f"Could not update the pool variable ({resp.status_code}): {resp.text}")
 
-            try:
-                self.client.apply(f"K8S autoscaller apply {new_pool=}".strip())
-            except Timeout as exc:
-                raise TFEProviderException("Connection to Terraform cloud timeout (5s)") from exc
+    async def _queue_run(self, message) -> str:
+        try:
+            resp = await self.client.apply(message)
+        except TFEConnectionError as exc:
+            raise TFEProviderException(f"Connection to Terraform cloud failed: {exc}") from exc
+        if not resp.ok:
+            raise TFEProviderException(f"Could not queue a run in TFE workspace ({resp.status_code}): {resp.text}")
+        try:
+            return resp.json()["data"]["id"]
+        except (ValueError, KeyError) as exc:
+            raise TFEProviderException(f"Could not queue a run in TFE workspace: {resp.text}") from exc
 
-            logging.info(f"Autoscaller {new_pool=}")
+    async def _run_in_progress(self) -> bool:
+        """Whether the last run queued by the autoscaler is still planning or applying"""
+        if self.run_id is None:
+            return False
 
+        try:
+            status = await self.client.get_run_status(self.run_id)
+        except TFEConnectionError as exc:
+            raise TFEProviderException(f"Connection to Terraform cloud failed: {exc}") from exc
+        except TFEAPIError as exc:
+            if exc.status_code == HTTP_NOT_FOUND:
+                # Deleted with its workspace history, nothing to wait for
+                logger.warning(f"Run {self.run_id} not found, not waiting for it")
+                self._forget_run()
+                return False
+            raise TFEProviderException(f"Could not read the status of run {self.run_id}: {exc}") from exc
+
+        if status in self.RUN_FINAL_STATUS:
+            logger.info(f"Run {self.run_id} finished with {status=}")
+            self._forget_run()
+            return False
+        if status in self.RUN_WAITING_STATUS:
+            now = time.monotonic()
+            if self._run_waiting_since is None:
+                self._run_waiting_since = now
+                logger.info(f"Run {self.run_id} waits for a confirmation: {status=}")
+            elif now - self._run_waiting_since >= self.confirm_timeout:
+                logger.warning(f"Run {self.run_id} still waiting for a confirmation after {self.confirm_timeout:.0f}s ({status=}), "
+                               "the next changes are queued in a new run")
+                self._forget_run()
+                return False
         else:
+            self._run_waiting_since = None
+        logger.debug(f"Run {self.run_id} in progress: {status=}")
+        return True
+
+    def _forget_run(self):
+        self.run_id = None
+        self._run_waiting_since = None
+
+    async def sync_status(self, apply_changes=True) -> dict[str, ProviderStatus]:
+        nodes_status = await self.get_nodes_status()
+        if not self._should_apply(apply_changes):
+            return nodes_status
+        nodes_to_start, nodes_to_stop = self._get_changes(nodes_status)
+
+        if len(nodes_to_start) == 0 and len(nodes_to_stop) == 0:
             logger.debug(f"No changes to apply")
+            return nodes_status
+
+        # Flagged nodes stay pending while a run is in flight, they are all applied
+        # together by a single run once the current one is done.
+        if await self._run_in_progress():
+            logger.info(f"Run {self.run_id} in progress, {len(nodes_to_start) + len(nodes_to_stop)} node changes pending")
+            return nodes_status
+
+        # Built from the pool read by this sync, the instances no longer managed, e.g. removed
+        # from the config, stay in the pool instead of being destroyed by the run.
+        new_pool = set(self.pool)
+        new_pool |= set([n.name for n in nodes_to_start])
+        new_pool -= set([n.name for n in nodes_to_stop])
+        logger.debug(f"Changes to apply: {new_pool=}")
+
+        # The run in progress check took a request, the server may have lost the right to write since
+        if not self._should_apply(apply_changes):
+            return nodes_status
+
+        # Cancelling the sync, e.g. on shutdown, must not update the pool without queuing its run
+        self._applying = asyncio.ensure_future(self._apply(new_pool, nodes_to_start, nodes_to_stop, nodes_status))
+        await asyncio.shield(self._applying)
         return nodes_status
+
+    async def _apply(self, new_pool: set[str], nodes_to_start: List[Node], nodes_to_stop: List[Node],
+                     nodes_status: dict[str, ProviderStatus]):
+        """Update the pool variable and queue its run"""
+        old_pool = self.pool
+        await self._update_pool(new_pool)
+        try:
+            self.run_id = await self._queue_run(f"K8S autoscaller apply {new_pool=}".strip())
+        except TFEProviderException:
+            # Without a run, the next sync would read the changes from the pool as applied
+            # and drop the flags. The pool goes back to its previous value, the flags are kept.
+            try:
+                await self._update_pool(old_pool)
+            except TFEProviderException as exc:
+                logger.error(f"Could not restore the pool variable after a failed run: {exc}")
+            raise
+
+        # The pool now holds the changes, report the new state and clear the flags
+        # so the nodes are not applied or picked again.
+        for n in nodes_to_start:
+            nodes_status[n.name] = ProviderStatus.RUNNING
+            n.flag = None
+        for n in nodes_to_stop:
+            nodes_status[n.name] = ProviderStatus.SHUTDOWN
+            n.flag = None
+
+        logging.info(f"Autoscaller {new_pool=} run={self.run_id}")
@@ -1,14 +1,25 @@
 """Module providing the class to interact with Terraform Cloud API
 """
 
+import asyncio
+import email.utils
 import json
+import random
+import time
+from dataclasses import dataclass
 
-import requests
-from requests.structures import CaseInsensitiveDict
+import aiohttp
 
-WORKSPACE_API = "https://app.terraform.io/api/v2/workspaces"
-RUNS_API = "https://app.terraform.io/api/v2/runs"
+from metrics import PROVIDER_CALL_LATENCY
+
+API_URL = "https://app.terraform.io/api/v2"
 API_CONTENT = "application/vnd.api+json"
+# Variable updates set the whole value, so they are safe to send twice. Queuing a run is not.
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PATCH"])
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+RETRY_AFTER_STATUS = frozenset([429, 503])
+BACKOFF_MAX = 120 # seconds
+HTTP_NOT_FOUND = 404
 
 
 class InvalidAPIToken(Exception):
@@ -19,45 +30,179 @@ class InvalidWorkspaceId(Exception):
     """Raised when the TFE workspace ID is invalid"""
 
 
+class TFEConnectionError(Exception):
+    """Raised when the TFE API could not be reached"""
+
+
+class TFEAPIError(Exception):
+    """Raised when the TFE API answered with an error status"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class TFEResponse:
+    status_code: int
+    content: bytes
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    @property
+    def text(self):
+        return self.content.decode(errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self, op):
+        if not self.ok:
+            raise TFEAPIError(f"{op} failed ({self.status_code}): {self.text[:200]}", self.status_code)
+
+
 class TFECLient:
-    """TFEClient provides functions to:
+    """TFEClient provides coroutines to:
     - retrieve a Terraform Cloud variable content
     - update a Terraform cloud variable content
-    - queue a run
+    - queue a run and follow its status
+
+    The HTTP session belongs to the event loop of its first call, see close().
     """
 
-    def __init__(self, token, workspace, timeout=5):
+    def __init__(self, token, workspace, timeout=5, retries=3, backoff=0.5, api_url=API_URL, cache_ttl=5):
         self.token = token
         self.workspace = workspace
-        self.headers = CaseInsensitiveDict()
-        self.headers["Accept"] = API_CONTENT
-        self.headers["Content-Type"] = API_CONTENT
-        self.headers["Authorization"] = f"Bearer {token}"
-        self.timeout = timeout
-
-        # Validate init parameters by trying to retrieve workspace
-        url = "/".join((WORKSPACE_API, self.workspace))
-        resp = requests.get(url, headers=self.headers, timeout=self.timeout).json()
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        # Variables read in the last `cache_ttl` seconds, by name: (expiry, variable)
+        self.cache_ttl = cache_ttl
+        self._variables = {}
+        self.workspace_api = "/".join((api_url, "workspaces"))
+        self.runs_api = "/".join((api_url, "runs"))
+        self._session = None
+        self._session_loop = None
+
+    async def validate(self):
+        """Check the token and the workspace by retrieving the workspace"""
+        url = "/".join((self.workspace_api, self.workspace))
+        resp = (await self._request("GET", url, "get_workspace")).json()
         if "errors" in resp:
             if resp["errors"][0]["status"] == "401":
                 raise InvalidAPIToken
             if resp["errors"][0]["status"] == "404":
                 raise InvalidWorkspaceId
 
-    def fetch_variable(self, var_name):
-        """Get a workspace variable content"""
-        url = "/".join((WORKSPACE_API, self.workspace, "vars"))
-        resp = requests.get(url, headers=self.headers, timeout=self.timeout)
-        data = resp.json()["data"]
-        for var in data:
-            if var["attributes"]["key"] == var_name:
-                return {
-                    "id": var["id"],
-                    "value": json.loads(var["attributes"]["value"]),
-                }
-        return None
-
-    def update_variable(self, var_id, value):
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Keep-alive session of the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession(timeout=self.timeout, headers={
+                "Accept": API_CONTENT,
+                "Content-Type": API_CONTENT,
+                "Authorization": f"Bearer {self.token}",
+            })
+            self._session_loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _backoff_time(self, attempt, headers=None):
+        """Exponential backoff with jitter. On 429 and 503, the Retry-After header takes precedence."""
+        retry_after = (headers or {}).get("Retry-After")
+        if retry_after is not None:
+            try:
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+                else:
+                    delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+                return min(BACKOFF_MAX, max(0.0, delay))
+            except (TypeError, ValueError):
+                pass
+        return min(BACKOFF_MAX, self.backoff * 2 ** attempt + random.random() * self.backoff)
+
+    async def _request(self, method, url, op, **kwargs) -> TFEResponse:
+        """Send a request, retrying the idempotent ones on connection errors and RETRY_STATUS.
+        The last response is returned, the API errors are handled by the caller.
+        """
+        retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        session = self._get_session()
+        for attempt in range(retries + 1):
+            try:
+                with PROVIDER_CALL_LATENCY.labels("tfe", op).time():
+                    async with session.request(method, url, **kwargs) as resp:
+                        response = TFEResponse(resp.status, await resp.read())
+                        headers = resp.headers if resp.status in RETRY_AFTER_STATUS else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                if attempt == retries:
+                    raise TFEConnectionError(f"{method} {url} failed: {exc!r}") from exc
+                await asyncio.sleep(self._backoff_time(attempt))
+                continue
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+            await asyncio.sleep(self._backoff_time(attempt, headers))
+
+    async def _list_variables(self):
+        """Yield the workspace variables, following the JSON:API pagination"""
+        url = "/".join((self.workspace_api, self.workspace, "vars"))
+        while url:
+            resp = await self._request("GET", url, "list_variables")
+            resp.raise_for_status("list_variables")
+            try:
+                body = resp.json()
+                variables = body["data"]
+            except (ValueError, KeyError, TypeError) as exc:
+                raise TFEAPIError(f"list_variables returned an invalid body: {resp.text[:200]}", resp.status_code) from exc
+            for var in variables:
+                yield var
+            url = (body.get("links") or {}).get("next")
+
+    async def _get_variable(self, var_id):
+        """Get a workspace variable by id, None when it does not exist anymore"""
+        url = "/".join((self.workspace_api, self.workspace, "vars", var_id))
+        resp = await self._request("GET", url, "get_variable")
+        if resp.status_code == HTTP_NOT_FOUND:
+            return None
+        resp.raise_for_status("get_variable")
+        try:
+            return resp.json()["data"]
+        except (ValueError, KeyError, TypeError) as exc:
+            raise TFEAPIError(f"get_variable returned an invalid body: {resp.text[:200]}", resp.status_code) from exc
+
+    async def fetch_variable(self, var_name, var_id=None):
+        """Get a workspace variable content.
+        The variable is read directly when its id is known, the variables are only listed when it is not found.
+        Raise TFEAPIError on the other API errors.
+        """
+        cached = self._variables.get(var_name)
+        if cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+
+        var = await self._get_variable(var_id) if var_id is not None else None
+        if var is None or var["attributes"]["key"] != var_name:
+            var = None
+            async for v in self._list_variables():
+                if v["attributes"]["key"] == var_name:
+                    var = v
+                    break
+        if var is None:
+            return None
+
+        variable = {
+            "id": var["id"],
+            "value": json.loads(var["attributes"]["value"]),
+        }
+        if self.cache_ttl > 0:
+            self._variables[var_name] = (time.monotonic() + self.cache_ttl, variable)
+        return variable
+
+    async def update_variable(self, var_id, value):
         """Update a workspace variable content"""
         patch_data = {
             "data": {
@@ -69,12 +214,12 @@ class TFECLient:
                 },
             }
         }
-        url = "/".join((WORKSPACE_API, self.workspace, "vars", var_id))
-        return requests.patch(
-            url, headers=self.headers, json=patch_data, timeout=self.timeout
-        )
+        url = "/".join((self.workspace_api, self.workspace, "vars", var_id))
+        # The cached value is stale even if the update fails halfway
+        self._variables = {name: cached for name, cached in self._variables.items() if cached[1]["id"] != var_id}
+        return await self._request("PATCH", url, "update_variable", json=patch_data)
 
-    def apply(self, message):
+    async def apply(self, message):
         """Queue a workspace run"""
         run_data = {
             "data": {
@@ -84,6 +229,14 @@ class TFECLient:
                 },
             }
         }
-        return requests.post(
-            RUNS_API, headers=self.headers, json=run_data, timeout=self.timeout
-        )
+        return await self._request("POST", self.runs_api, "apply", json=run_data)
+
+    async def get_run_status(self, run_id):
+        """Get the status of a run, e.g. planning, applied or errored"""
+        url = "/".join((self.runs_api, run_id))
+        resp = await self._request("GET", url, "get_run_status")
+        resp.raise_for_status("get_run_status")
+        try:
+            return resp.json()["data"]["attributes"]["status"]
+        except (ValueError, KeyError, TypeError) as exc:
+            raise TFEAPIError(f"get_run_status returned an invalid body: {resp.text[:200]}", resp.status_code) from exc
@@ -3,84 +3,476 @@ import pathlib
 import argparse
 import sys
 import os
+import time
 
 # Add protos in python path
 sys.path.append(os.path.dirname(__file__) + "/protos")
 
-
-from providers.tfe import TFEProvider
-
-
 logger = logging.getLogger(__name__)
 
-from providers.minikube import MinikubeProvider
+from providers.base import AsyncProviderBase, ProviderBase, as_async
+from providers.registry import load_provider
 import asyncio
-from typing import Optional
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
 import re
 
 import yaml
 import grpc
 from protos import externalgrpc_pb2
 from protos import externalgrpc_pb2_grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 
 from protos.externalgrpc_pb2 import NodeGroupDeleteNodesRequest, NodeGroupDeleteNodesResponse, NodeGroupsRequest, NodeGroupsResponse, RefreshRequest, RefreshResponse, NodeGroupForNodeRequest, NodeGroupForNodeResponse, GPULabelRequest,\
         GPULabelResponse, NodeGroupTargetSizeRequest, NodeGroupTargetSizeResponse, NodeGroupNodesRequest, NodeGroupNodesResponse, NodeGroupAutoscalingOptionsRequest, NodeGroupAutoscalingOptionsResponse, \
-        GetAvailableGPUTypesRequest, GetAvailableGPUTypesResponse, NodeGroupIncreaseSizeRequest, NodeGroupIncreaseSizeResponse, NodeGroupTemplateNodeInfoRequest,  NodeGroupTemplateNodeInfoResponse
+        GetAvailableGPUTypesRequest, GetAvailableGPUTypesResponse, NodeGroupIncreaseSizeRequest, NodeGroupIncreaseSizeResponse, NodeGroupTemplateNodeInfoRequest,  NodeGroupTemplateNodeInfoResponse, \
+        NodeGroupDecreaseTargetSizeRequest, NodeGroupDecreaseTargetSizeResponse
 
 from node import NodeGroup, Node, NodeStatus, Specs
-from kube_operator import KubeOperator
+if TYPE_CHECKING:
+    from kube_operator import KubeOperator
+    from leader import LeaderElector
 
 from config import Config
+from state import State, StateException, load_state, save_state
+from metrics import METRICS_PORT, SYNC_LATENCY, MetricsInterceptor, start_metrics_server
 
 
 class NodeGroupNotFound(Exception):
     pass
 
+class ResponseCache:
+    """Prebuilt RPC responses, rebuilt when the state generation they were built from changes"""
+    def __init__(self):
+        self._responses = {}
+
+    def get(self, key, generation, build):
+        cached = self._responses.get(key)
+        if cached is None or cached[0] != generation:
+            cached = (generation, build())
+            self._responses[key] = cached
+        return cached[1]
+
+    def clear(self):
+        self._responses = {}
+
 GPULabel = "k8s.magiccastle.com/gpu"
 
-GROUP_ID_REGEX = re.compile(r'\D+(?=\d)') # TODO: Probably safer to set the group in the config file
+GROUP_ID_REGEX = re.compile(r'\D+(?=\d)') # Group of the instances declared without `group`
 POOL_TF_VARIABLE = "pool"
+RECONCILE_INTERVAL = 10 # seconds
+MAX_STALENESS = 30 # seconds
+CONFIG_POLL_INTERVAL = 10 # seconds
+BATCH_WINDOW = 2 # seconds
+LISTEN_ADDRESS = "[::]:8086"
+LEASE_NAME = "externalgrpc-autoscaler"
+HEALTH_INTERVAL = 1 # seconds
+CLOUD_PROVIDER_SERVICE = externalgrpc_pb2.DESCRIPTOR.services_by_name["CloudProvider"].full_name
+COMPRESSION = {"none": grpc.Compression.NoCompression, "gzip": grpc.Compression.Gzip, "deflate": grpc.Compression.Deflate}
+
+@dataclass
+class ServerOptions:
+    listen_address: str = LISTEN_ADDRESS
+    max_concurrent_rpcs: Optional[int] = None # extra RPCs are rejected with RESOURCE_EXHAUSTED
+    max_message_size: Optional[int] = None # bytes
+    keepalive_time: Optional[float] = None # seconds
+    keepalive_timeout: Optional[float] = None # seconds
+    compression: str = "none" # default compression of all the responses
+
+    def grpc_options(self) -> list[tuple[str, int]]:
+        options = []
+        if self.max_message_size is not None:
+            options.append(("grpc.max_send_message_length", self.max_message_size))
+            options.append(("grpc.max_receive_message_length", self.max_message_size))
+        if self.keepalive_time is not None:
+            options.append(("grpc.keepalive_time_ms", int(self.keepalive_time * 1000)))
+        if self.keepalive_timeout is not None:
+            options.append(("grpc.keepalive_timeout_ms", int(self.keepalive_timeout * 1000)))
+        return options
 
 class CloudProvider(externalgrpc_pb2_grpc.CloudProviderServicer):
-    def __init__(self, config_path="config.yaml"):
-        self.node_group = []
+    def __init__(self, config_path="config.yaml", reconcile_interval=RECONCILE_INTERVAL, max_staleness=MAX_STALENESS,
+                 state_file=None, nodes_compression_threshold=None, batch_window=BATCH_WINDOW, batch_max_nodes=0,
+                 defer_init=False):
+        self.reconcile_interval = reconcile_interval
+        self.max_staleness = max_staleness
+        self.batch_window = batch_window
+        self.batch_max_nodes = batch_max_nodes
+        self.nodes_compression_threshold = nodes_compression_threshold
+        self.state_file = state_file
+        self.config_path = config_path
+        self._config_signature = self._stat_config()
         config = Config.from_yaml(config_path)
+        # Provider settings are only read at startup, reloads apply the instances
+        self.provider_config = config.provider
+
+        self.node_group, self._node_group_by_id, self._node_by_name = [], {}, {}
+        self._apply_inventory(self._inventory(config))
+        self._responses = ResponseCache()
+        self._unmanaged_node_response = NodeGroupForNodeResponse(nodeGroup=NodeGroup().to_protobuf())
+
+        # Kubernetes and blocking provider calls run outside of the event loop, async providers run on it.
+        # A single worker and the sync lock keep syncs and config reloads from overlapping.
+        self._sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sync")
+        self._sync_lock = asyncio.Lock()
+        self._sync_task: Optional[asyncio.Task] = None
+        self._last_sync = None
+        self._synced = False
+        self._reconcile_requested: Optional[asyncio.Event] = None
+        # Start of the batch of changes requested by the autoscaler, None when no batch is open
+        self._batch_started: Optional[float] = None
+
+        self.provider: Optional[ProviderBase] = None
+        # The provider behind the async contract, see providers.base.as_async
+        self._async_provider: Optional[AsyncProviderBase] = None
+        self.operator: Optional["KubeOperator"] = None
+        self._restored = False
+        # Set by serve with --leader-elect, without it this replica always writes
+        self.leader: Optional["LeaderElector"] = None
+        self._config = config
+        if not defer_init:
+            self._run_blocking(self.initialize())
+            if not self._restored:
+                self._run_blocking(self._sync_status())
+
+    def _run_blocking(self, coro):
+        """Run a coroutine from blocking code, on an event loop of its own in a helper thread.
+        The provider resources bound to that loop are released before it closes.
+        """
+        async def run():
+            try:
+                return await coro
+            finally:
+                if self._async_provider is not None:
+                    await self._async_provider.close()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="blocking") as executor:
+            return executor.submit(asyncio.run, run()).result()
+
+    async def initialize(self):
+        """Create the provider and the operator, then restore the state snapshot.
+        Their startup calls (Terraform Cloud, kube config and node list) run concurrently.
+        """
+        loop = asyncio.get_running_loop()
+        config, self._config = self._config, None
+        all_nodes = [n for ng in self.node_group for n in ng.nodes]
+        operator = None
+        if not self._provider_class(config).OWN_CLUSTER:
+            operator = loop.run_in_executor(self._sync_executor, self._create_operator, config, all_nodes)
+        # Blocking providers may call their API in the constructor
+        provider = await loop.run_in_executor(None, self._create_provider, config, all_nodes)
+        async_provider = as_async(provider, self._sync_executor)
+        if operator is None:
+            # The nodes join the cluster of the provider, the operator waits for it
+            operator = loop.run_in_executor(self._sync_executor, self._create_operator, config, all_nodes, provider.kube_client())
+        try:
+            results = await asyncio.gather(operator, async_provider.start(), return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+        except BaseException:
+            # The provider is dropped, release what its start opened, e.g. the HTTP session
+            await async_provider.close()
+            raise
+        self.operator = results[0]
+        self.provider, self._async_provider = provider, async_provider
+        logger.debug(f"Provider: {self.provider}")
+
+        # A restored state is served right away and reconciled in the background
+        self._restored = self._restore_state()
+
+    async def start(self):
+        """Initialize, then run the first sync. A restored state is served right away instead,
+        reconcile_loop runs the first sync in the background.
+        """
+        await self.initialize()
+        if not self._restored:
+            await self.sync_status()
+
+    async def stop(self):
+        """Cancel the sync in flight, which aborts the provider calls, and release the provider resources"""
+        if self._sync_task is not None and not self._sync_task.done():
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+        if self._async_provider is not None:
+            await self._async_provider.close()
+
+    def is_ready(self) -> bool:
+        """Whether the node state can be served, from a sync or from the restored snapshot.
+        A standby replica is never ready, the cluster autoscaler only talks to the leader.
+        """
+        return self.operator is not None and (self._synced or self._restored) and self.is_leader()
+
+    def is_leader(self) -> bool:
+        return self.leader is None or self.leader.is_leader()
+
+    @staticmethod
+    def _inventory(config: Config) -> dict[str, tuple[Specs, list[str]]]:
+        """Specs and instance names of each group, validated before any change is applied"""
+        inventory = {}
+        seen = set()
+
+        def add(group_id, specs, names):
+            group_specs, group_names = inventory.setdefault(group_id, (specs, []))
+            if group_specs != specs:
+                raise Exception(f"Specs of node group {group_id} differ between instances: {group_specs} != {specs}")
+            for name in names:
+                if name in seen:
+                    raise Exception(f"Instance {name} is declared twice in the config")
+                seen.add(name)
+                group_names.append(name)
+
+        # Group declarations share the specs, they are only checked once per group
+        for group in config.groups:
+            add(group.id, Specs(**group.specs), group.names())
 
         for instance in config.instances:
-            name = instance.name
-            group_id = GROUP_ID_REGEX.match(name)
-            if group_id:
+            group_id = instance.group
+            if group_id is None:
+                group_id = GROUP_ID_REGEX.match(instance.name)
+                if group_id is None:
+                    continue
                 group_id = group_id.group(0)
-
-                node = Node(name=name, status=NodeStatus.UNKNOWN, provider_id=config.provider.id)
-                specs = Specs(**instance.specs)
-
-                existing_node_group = False
-                for node_group in self.node_group:
-                    if node_group.id == group_id:
-                        existing_node_group = True
-                        assert node_group.specs == specs
-                        node_group.nodes.append(node)
-
-                if not existing_node_group:
-                    node_group = NodeGroup(nodes=[node], id=group_id, specs=specs)
-                    self.node_group.append(node_group)
-
+            add(group_id, Specs(**instance.specs), [instance.name])
+        return inventory
+
+    def _apply_inventory(self, inventory: dict[str, tuple[Specs, list[str]]]) -> tuple[list[Node], list[Node]]:
+        """Match the node groups to the inventory, return the added and removed nodes.
+        Nodes still in the inventory keep their status and pending flag, even when they change group.
+        Live groups are never changed: the changed ones are rebuilt and swapped in with the indexes.
+        """
+        wanted = {name for _, names in inventory.values() for name in names}
+        current = self._node_by_name
+
+        removed = []
+        for name, (_, node) in current.items():
+            if name not in wanted:
+                removed.append(node)
+                if node.status not in [NodeStatus.SHUTDOWN, NodeStatus.UNKNOWN]:
+                    logger.warning(f"node={name} removed from config while {node.status}, it is no longer managed and left as is")
+
+        added = []
+        node_group = []
+        for group_id, (specs, names) in inventory.items():
+            ng = self._node_group_by_id.get(group_id)
+            if ng is None or ng.specs != specs or [n.name for n in ng.nodes] != names:
+                nodes = []
+                for name in names:
+                    if name in current:
+                        node = current[name][1]
+                    else:
+                        node = Node(name=name, status=NodeStatus.UNKNOWN, provider_id=self.provider_config.id)
+                        added.append(node)
+                    nodes.append(node)
+                ng = NodeGroup(nodes=nodes, id=group_id, specs=specs)
+            node_group.append(ng)
+
+        for node in removed:
+            node.group = None
+        # RPCs read the groups and the indexes together, they are replaced in a single assignment
+        self.node_group, self._node_group_by_id, self._node_by_name = node_group, *self._indexes(node_group)
+        return added, removed
+
+    def _stat_config(self):
+        # ConfigMap volumes are updated by swapping a symlink, stat follows it to the new file
+        st = os.stat(self.config_path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    async def reload_config(self):
+        """Apply the instances added, removed or moved in the config file since the last load.
+        Runs under the sync lock so the inventory never changes during a sync.
+        """
+        loop = asyncio.get_running_loop()
+
+        def load():
+            config = Config.from_yaml(self.config_path)
+            return config, self._inventory(config)
+
+        config, inventory = await loop.run_in_executor(self._sync_executor, load)
+        if config.provider != self.provider_config:
+            logger.warning("Provider config changed, restart the server to apply it")
+
+        # On the event loop, no RPC runs while the groups are swapped
+        added, removed = self._apply_inventory(inventory)
         all_nodes = [n for ng in self.node_group for n in ng.nodes]
-        match config.provider:
-            case Config.Minikube():
-                self.provider = MinikubeProvider(all_nodes)
-            case Config.TFE():
-                self.provider = TFEProvider(all_nodes, config.provider)
-            case _:
-                raise Exception("InvalidType for provider")
-        logger.debug(f"Provider: {self.provider}")
 
-        self.operator = KubeOperator(all_nodes)
-
-        # Update initial state
-        provider_nodes_state = self.provider.sync_status()
-        self.operator.sync_status(provider_nodes_state)
+        def set_managed_nodes():
+            self.provider.set_managed_nodes(all_nodes)
+            self.operator.set_managed_nodes(all_nodes)
+
+        await loop.run_in_executor(self._sync_executor, set_managed_nodes)
+        self._responses.clear()
+        logger.info(f"Config reloaded: {len(added)} nodes added, {len(removed)} removed, {len(self.node_group)} node groups")
+
+    async def config_watch_loop(self, interval):
+        """Reload the config file when it changes on disk"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                signature = self._stat_config()
+                if signature == self._config_signature:
+                    continue
+                # A broken file is not retried until it changes again
+                self._config_signature = signature
+                async with self._sync_lock:
+                    await self.reload_config()
+                self.request_reconcile()
+            except Exception:
+                logger.exception("Config reload failed, keeping the current inventory")
+
+    def _provider_class(self, config: Config) -> type[ProviderBase]:
+        return load_provider(config.provider.id)
+
+    def _create_provider(self, config: Config, nodes: list[Node]) -> ProviderBase:
+        return self._provider_class(config)(nodes, config.provider)
+
+    def _create_operator(self, config: Config, nodes: list[Node], kube_client=None) -> "KubeOperator":
+        # The kubernetes client is the largest import, it is loaded once the config is valid
+        from kube_operator import KubeOperator
+        match kube_client:
+            case (api, watcher):
+                return KubeOperator(nodes, api=api, watcher=watcher)
+            case _:
+                return KubeOperator(nodes)
+
+    def _pending_changes(self) -> int:
+        return sum(sum(ng.count_by_flag().values()) for ng in self.node_group)
+
+    def _flush_due(self) -> bool:
+        """Whether the pending changes are applied by the next sync"""
+        if self._batch_started is None:
+            # Changes left by the previous flush or restored from the state are not held again
+            return True
+        if time.monotonic() - self._batch_started >= self.batch_window:
+            return True
+        return self.batch_max_nodes > 0 and self._pending_changes() >= self.batch_max_nodes
+
+    def _changes_requested(self):
+        """Open a batch with the first change, it is flushed after `batch_window` or once `batch_max_nodes` are pending"""
+        if self.batch_max_nodes > 0 and self._pending_changes() >= self.batch_max_nodes:
+            self.request_reconcile()
+        elif self._batch_started is None:
+            self._batch_started = time.monotonic()
+            asyncio.get_running_loop().call_later(self.batch_window, self.request_reconcile)
+
+    async def _sync_status(self):
+        async with self._sync_lock:
+            started = time.monotonic()
+            # A standby keeps its state warm but leaves the provider and the nodes to the leader
+            leader = self.is_leader()
+            apply_changes = leader and self._flush_due()
+            if apply_changes:
+                # Changes requested during this sync open a new batch
+                self._batch_started = None
+                for ng in self.node_group:
+                    ng.begin_apply()
+            elif leader:
+                logger.debug(f"Holding {self._pending_changes()} changes until the end of the batch window")
+            with SYNC_LATENCY.labels("provider").time():
+                # The leadership is checked again right before the changes are applied
+                provider_nodes_state = await self._async_provider.sync_status(
+                        apply_changes=self.is_leader if apply_changes else False)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._sync_executor, self._sync_operator, provider_nodes_state, leader, started)
+
+    def _sync_operator(self, provider_nodes_state, leader, started):
+        with SYNC_LATENCY.labels("operator").time():
+            # The leadership may have been lost during the provider sync
+            self.operator.sync_status(provider_nodes_state, write=leader and self.is_leader())
+        # The status of the nodes applied by the provider is now up to date
+        for ng in self.node_group:
+            ng.end_apply()
+        self._last_sync = started
+        self._synced = True
+        self._save_state()
+
+    def _save_state(self):
+        if self.state_file is None:
+            return
+        # The monotonic sync time is converted to wall clock to survive the restart
+        last_sync = None if self._last_sync is None else time.time() - (time.monotonic() - self._last_sync)
+        state = State(nodes={n.name: (n.status, n.flag) for ng in self.node_group for n in ng.nodes},
+                      provider=self.provider.get_state(), last_sync=last_sync)
+        try:
+            save_state(self.state_file, state)
+        except OSError as e:
+            logger.warning(f"Could not save state to {self.state_file}: {e}")
+
+    def _restore_state(self) -> bool:
+        """Restore the node status and pending flags of the last snapshot"""
+        if self.state_file is None:
+            return False
+        try:
+            state = load_state(self.state_file)
+        except StateException as e:
+            logger.warning(f"Ignoring state file {self.state_file}: {e}")
+            return False
+        if state is None:
+            return False
+
+        restored = 0
+        for name, (status, flag) in state.nodes.items():
+            found = self._node_by_name.get(name)
+            # Instances removed from the config since the snapshot are skipped
+            if found is not None:
+                _, node = found
+                node.status = status
+                node.flag = flag
+                restored += 1
+        self.provider.set_state(state.provider)
+        if state.last_sync is not None:
+            self._last_sync = time.monotonic() - max(0.0, time.time() - state.last_sync)
+        logger.info(f"Restored {restored} nodes from {self.state_file} saved {time.time() - state.saved_at:.0f}s ago")
+        return True
+
+    async def sync_status(self):
+        """Sync provider and operator state without blocking the event loop.
+        Concurrent callers share the sync in flight instead of queuing a new one.
+        """
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.ensure_future(self._sync_status())
+        # A cancelled caller must not cancel the sync shared with the others
+        await asyncio.shield(self._sync_task)
+
+    def is_stale(self) -> bool:
+        return self._last_sync is None or time.monotonic() - self._last_sync > self.max_staleness
+
+    def request_reconcile(self):
+        """Wake up the reconcile loop before the end of its interval"""
+        if self._reconcile_requested is not None:
+            self._reconcile_requested.set()
+
+    async def reconcile_loop(self):
+        """Keep provider and operator state fresh independently of the Refresh calls"""
+        self._reconcile_requested = asyncio.Event()
+        if self._restored and not self._synced:
+            # The restored state was not checked against the provider and the cluster yet
+            self._reconcile_requested.set()
+        while True:
+            try:
+                await asyncio.wait_for(self._reconcile_requested.wait(), timeout=self.reconcile_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._reconcile_requested.clear()
+
+            try:
+                await self.sync_status()
+            except Exception:
+                logger.exception("Background reconcile failed")
+
+    @staticmethod
+    def _indexes(node_group: list[NodeGroup]) -> tuple[dict[str, NodeGroup], dict[str, tuple[NodeGroup, Node]]]:
+        """Index node groups by id and nodes by name"""
+        by_id = {ng.id: ng for ng in node_group}
+        by_name = {n.name: (ng, n) for ng in node_group for n in ng.nodes}
+        return by_id, by_name
+
+    def _state_generation(self) -> int:
+        return max(ng.generation for ng in self.node_group) if self.node_group else 0
 
     async def GPULabel( self, request: GPULabelRequest, context: grpc.aio.ServicerContext,
                          ) -> GPULabelResponse:
@@ -97,34 +489,42 @@ class CloudProvider(externalgrpc_pb2_grpc.CloudProviderServicer):
                          ) -> NodeGroupsResponse:
         logger.debug(f"NodeGroups")
 
-        return NodeGroupsResponse(nodeGroups=[ng.to_protobuf() for ng in self.node_group])
+        return self._responses.get("NodeGroups", self._state_generation(),
+                lambda: NodeGroupsResponse(nodeGroups=[ng.to_protobuf() for ng in self.node_group]))
 
     async def NodeGroupForNode( self, request: NodeGroupForNodeRequest, context: grpc.aio.ServicerContext,
                          ) -> NodeGroupForNodeResponse:
         name = request.node.name
-        for ng in self.node_group:
-            for n in ng.nodes:
-                if n.name == name:
-                    logger.debug(f"NodeGroupForNode: node={name} found")
-                    return NodeGroupForNodeResponse(nodeGroup=ng.to_protobuf())
+        found = self._node_by_name.get(name)
+        if found is not None:
+            ng, _ = found
+            logger.debug(f"NodeGroupForNode: node={name} found")
+            return self._responses.get(("NodeGroupForNode", ng.id), ng.generation,
+                    lambda: NodeGroupForNodeResponse(nodeGroup=ng.to_protobuf()))
 
         # Empty NodeGroup for unmanaged node
         logger.debug(f"NodeGroupForNode: node={name} not found")
-        return NodeGroupForNodeResponse(nodeGroup=NodeGroup().to_protobuf())
+        return self._unmanaged_node_response
 
     async def Refresh( self, request: RefreshRequest, context: grpc.aio.ServicerContext,
                       ) -> RefreshResponse:
-        provider_nodes_state = self.provider.sync_status()
-        self.operator.sync_status(provider_nodes_state)
+        # The reconcile loop keeps the state fresh, only wait for a sync when it fell behind
+        if self.is_stale():
+            logger.debug("Refresh: state is stale, waiting for sync")
+            # The wait ends with the deadline of the call, the sync goes on for the other callers
+            timeout = context.time_remaining() if context is not None else None
+            try:
+                await asyncio.wait_for(self.sync_status(), timeout)
+            except asyncio.TimeoutError:
+                await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "Sync still in progress")
 
         return RefreshResponse()
 
     def get_node_group_by_id(self, id) -> NodeGroup:
-        for ng in self.node_group:
-            if ng.id == id:
-                return ng
-
-        raise NodeGroupNotFound("NodeGroup not found from request args")
+        ng = self._node_group_by_id.get(id)
+        if ng is None:
+            raise NodeGroupNotFound("NodeGroup not found from request args")
+        return ng
 
     async def NodeGroupTargetSize( self, request: NodeGroupTargetSizeRequest, context: grpc.aio.ServicerContext,
                       ) -> NodeGroupTargetSizeResponse:
@@ -139,8 +539,14 @@ class CloudProvider(externalgrpc_pb2_grpc.CloudProviderServicer):
         ng = self.get_node_group_by_id(request.id)
         logger.debug(f"NodeGroupNodes: {ng.id}")
 
-        active_nodes = ng.get_running_nodes(include_deleting=True)
-        return NodeGroupNodesResponse(instances=[n.to_protobuf() for n in active_nodes])
+        def build():
+            active_nodes = ng.get_running_nodes(include_deleting=True)
+            return NodeGroupNodesResponse(instances=[n.to_protobuf() for n in active_nodes])
+        response = self._responses.get(("NodeGroupNodes", ng.id), ng.generation, build)
+        # Large groups list thousands of instances, their ids compress well
+        if self.nodes_compression_threshold is not None and response.ByteSize() > self.nodes_compression_threshold:
+            context.set_compression(grpc.Compression.Gzip)
+        return response
 
     async def NodeGroupGetOptions( self, request: NodeGroupAutoscalingOptionsRequest, context: grpc.aio.ServicerContext,
                       ) -> NodeGroupAutoscalingOptionsResponse:
@@ -157,6 +563,7 @@ class CloudProvider(externalgrpc_pb2_grpc.CloudProviderServicer):
         nodes_name = [n.name for n in request.nodes]
 
         ng.delete_nodes(nodes_name)
+        self._changes_requested()
 
         return NodeGroupDeleteNodesResponse()
 
@@ -167,33 +574,224 @@ class CloudProvider(externalgrpc_pb2_grpc.CloudProviderServicer):
         ng = self.get_node_group_by_id(request.id)
 
         ng.increase_size(request.delta)
+        self._changes_requested()
 
         return NodeGroupIncreaseSizeResponse()
 
-    async def NodeGroupTemplateNodeInfo( self, request: NodeGroupTemplateNodeInfoRequest, context: grpc.aio.ServicerContext,
-                      ) -> NodeGroupTemplateNodeInfoResponse:
+    async def NodeGroupDecreaseTargetSize( self, request: NodeGroupDecreaseTargetSizeRequest, context: grpc.aio.ServicerContext,
+                      ) -> NodeGroupDecreaseTargetSizeResponse:
+
+        logger.debug("DecreaseTargetSize")
         ng = self.get_node_group_by_id(request.id)
-        node_info = {
-                "status" : ng.specs.to_protobuf()
-                }
-        return NodeGroupTemplateNodeInfoResponse(nodeInfo=node_info)
 
+        ng.decrease_target_size(request.delta)
+        self._changes_requested()
 
+        return NodeGroupDecreaseTargetSizeResponse()
 
-async def serve(config) -> None:
-    server = grpc.aio.server()
-    externalgrpc_pb2_grpc.add_CloudProviderServicer_to_server(CloudProvider(config_path=config), server)
-    listen_addr = "[::]:8086"
-    server.add_insecure_port(listen_addr)
-    logging.info("Starting server on %s", listen_addr)
+    async def NodeGroupTemplateNodeInfo( self, request: NodeGroupTemplateNodeInfoRequest, context: grpc.aio.ServicerContext,
+                      ) -> NodeGroupTemplateNodeInfoResponse:
+        ng = self.get_node_group_by_id(request.id)
+
+        def build():
+            node_info = {
+                    "status" : ng.specs.to_protobuf()
+                    }
+            return NodeGroupTemplateNodeInfoResponse(nodeInfo=node_info)
+        # The template only depends on the group specs
+        return self._responses.get(("NodeGroupTemplateNodeInfo", ng.id), 0, build)
+
+
+
+class ReadinessInterceptor(grpc.aio.ServerInterceptor):
+    """Reject the CloudProvider RPCs with UNAVAILABLE until the node state is known"""
+    def __init__(self, cloud_provider: CloudProvider):
+        self.cloud_provider = cloud_provider
+        self._unavailable = grpc.unary_unary_rpc_method_handler(self._reject)
+
+    @staticmethod
+    async def _reject(request, context):
+        await context.abort(grpc.StatusCode.UNAVAILABLE, "Cloud provider is initializing")
+
+    async def intercept_service(self, continuation, handler_call_details):
+        if self.cloud_provider.is_ready() or not handler_call_details.method.startswith(f"/{CLOUD_PROVIDER_SERVICE}/"):
+            return await continuation(handler_call_details)
+        return self._unavailable
+
+
+def create_server(cloud_provider: CloudProvider, options: ServerOptions,
+                  health_servicer: Optional[health.aio.HealthServicer] = None) -> tuple[grpc.aio.Server, int]:
+    """Create the gRPC server of the cloud provider, return it with its bound port"""
+    # The readiness check runs first, MetricsInterceptor caches the handlers it returns
+    server = grpc.aio.server(interceptors=[ReadinessInterceptor(cloud_provider), MetricsInterceptor()],
+                             options=options.grpc_options(),
+                             maximum_concurrent_rpcs=options.max_concurrent_rpcs,
+                             compression=COMPRESSION[options.compression])
+    externalgrpc_pb2_grpc.add_CloudProviderServicer_to_server(cloud_provider, server)
+    if health_servicer is not None:
+        health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+    port = server.add_insecure_port(options.listen_address)
+    return server, port
+
+
+def event_loop_factory(use_uvloop: bool):
+    if not use_uvloop:
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("uvloop is not installed, using the default asyncio event loop")
+        return None
+    return uvloop.new_event_loop
+
+
+def profile_imports(config_path, top=20):
+    """Print the slowest imports of a startup with the provider of `config_path`, without starting the server"""
+    code = f"import server, config, kube_operator; config.Config.from_yaml({str(os.path.abspath(config_path))!r})"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else f"Import failed ({result.returncode=})")
+        return
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            imports.append((int(fields[1]), int(fields[0]), fields[2].strip()))
+
+    print(f"{len(imports)} modules imported in {sum(i[1] for i in imports) / 1e6:.3f}s")
+    print(f"{'cumulative (ms)':>16}{'self (ms)':>12}  module")
+    for cumulative, own, name in sorted(imports, reverse=True)[:top]:
+        print(f"{cumulative / 1e3:>16.1f}{own / 1e3:>12.1f}  {name}")
+
+
+async def serve(config, reconcile_interval=RECONCILE_INTERVAL, max_staleness=MAX_STALENESS, metrics_port=METRICS_PORT,
+                config_poll_interval=CONFIG_POLL_INTERVAL, state_file=None, server_options=ServerOptions(),
+                nodes_compression_threshold=None, batch_window=BATCH_WINDOW, batch_max_nodes=0,
+                leader_elect=False, lease_name=LEASE_NAME, lease_namespace=None) -> None:
+    cloud_provider = CloudProvider(config_path=config, reconcile_interval=reconcile_interval, max_staleness=max_staleness,
+                                   state_file=state_file, nodes_compression_threshold=nodes_compression_threshold,
+                                   batch_window=batch_window, batch_max_nodes=batch_max_nodes, defer_init=True)
+    health_servicer = health.aio.HealthServicer()
+    for service in ["", CLOUD_PROVIDER_SERVICE]:
+        await health_servicer.set(service, health_pb2.HealthCheckResponse.NOT_SERVING)
+
+    # Bind the port before the provider and Kubernetes calls, the health service tells when the state is ready
+    server, _ = create_server(cloud_provider, server_options, health_servicer)
+    logging.info("Starting server on %s", server_options.listen_address)
     await server.start()
-    await server.wait_for_termination()
+    start_metrics_server(metrics_port, lambda: cloud_provider.node_group)
+
+    serving = False
+
+    async def update_health():
+        nonlocal serving
+        if cloud_provider.is_ready() == serving:
+            return
+        serving = not serving
+        status = health_pb2.HealthCheckResponse.SERVING if serving else health_pb2.HealthCheckResponse.NOT_SERVING
+        for service in ["", CLOUD_PROVIDER_SERVICE]:
+            await health_servicer.set(service, status)
+
+    async def health_loop():
+        # The leadership expires on its own when the lease is not renewed, the status is polled
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            await update_health()
+
+    tasks = []
+    elector = None
+    if leader_elect:
+        from leader import LeaderElector
+        api = await asyncio.get_running_loop().run_in_executor(None, LeaderElector.create_api)
+        elector = LeaderElector(api, lease_name, namespace=lease_namespace)
+        # Set before the first sync, a standby must not write while it starts
+        cloud_provider.leader = elector
+
+        def on_leader_change(leader):
+            if leader:
+                # The syncs of the standby did not apply anything
+                cloud_provider.request_reconcile()
+        tasks.append(asyncio.create_task(elector.run(on_leader_change)))
+
+    started = time.monotonic()
+    await cloud_provider.start()
+    await update_health()
+    tasks.append(asyncio.create_task(health_loop()))
+    logging.info(f"Cloud provider ready in {time.monotonic() - started:.1f}s")
+
+    tasks.append(asyncio.create_task(cloud_provider.reconcile_loop()))
+    if config_poll_interval > 0:
+        tasks.append(asyncio.create_task(cloud_provider.config_watch_loop(config_poll_interval)))
+    try:
+        await server.wait_for_termination()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await cloud_provider.stop()
+        if elector is not None:
+            # The standby takes over without waiting for the lease to expire
+            try:
+                elector.release()
+            except Exception as e:
+                logging.warning(f"Could not release the lease: {e}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Autoscaler')
     parser.add_argument('config', type=pathlib.Path)
+    parser.add_argument('--reconcile-interval', type=float, default=RECONCILE_INTERVAL,
+                        help='Seconds between two background syncs of the provider and Kubernetes state')
+    parser.add_argument('--max-staleness', type=float, default=MAX_STALENESS,
+                        help='Refresh waits for a sync when the state is older than this many seconds')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='Port of the Prometheus /metrics endpoint')
+    parser.add_argument('--config-poll-interval', type=float, default=CONFIG_POLL_INTERVAL,
+                        help='Seconds between two checks of the config file for changes, 0 to disable the reload')
+    parser.add_argument('--state-file', type=pathlib.Path, default=None,
+                        help='Snapshot of the node state written after each sync and restored on startup')
+    parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW,
+                        help='Seconds to collect the scale up and down requests of all the groups before applying them together')
+    parser.add_argument('--batch-max-nodes', type=int, default=0,
+                        help='Apply the batch before the end of the window once this many node changes are pending (default: no limit)')
+    parser.add_argument('--listen-address', default=LISTEN_ADDRESS,
+                        help='Address and port of the gRPC server')
+    parser.add_argument('--max-concurrent-rpcs', type=int, default=None,
+                        help='RPCs over this limit are rejected with RESOURCE_EXHAUSTED (default: unlimited)')
+    parser.add_argument('--max-message-size', type=int, default=None,
+                        help='Maximum size in bytes of the gRPC requests and responses (default: gRPC default)')
+    parser.add_argument('--keepalive-time', type=float, default=None,
+                        help='Seconds between two keepalive pings sent on idle connections')
+    parser.add_argument('--keepalive-timeout', type=float, default=None,
+                        help='Seconds to wait for a keepalive ping answer before closing the connection')
+    parser.add_argument('--compression', choices=list(COMPRESSION), default="none",
+                        help='Default compression of the gRPC responses')
+    parser.add_argument('--nodes-compression-threshold', type=int, default=None,
+                        help='Gzip the NodeGroupNodes responses larger than this many bytes')
+    parser.add_argument('--leader-elect', action='store_true',
+                        help='Run as one of several replicas, only the holder of the lease writes and serves')
+    parser.add_argument('--lease-name', default=LEASE_NAME,
+                        help='Name of the coordination.k8s.io Lease used for the leader election')
+    parser.add_argument('--lease-namespace', default=None,
+                        help='Namespace of the Lease (default: namespace of the pod)')
+    parser.add_argument('--uvloop', action='store_true',
+                        help='Run on the uvloop event loop when it is installed')
+    parser.add_argument('--profile-imports', action='store_true',
+                        help='Print the import time of the modules loaded on startup with this config, then exit')
     args = parser.parse_args()
 
+    if args.profile_imports:
+        profile_imports(args.config)
+        sys.exit()
+
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(serve(args.config))
+    server_options = ServerOptions(listen_address=args.listen_address, max_concurrent_rpcs=args.max_concurrent_rpcs,
+                                   max_message_size=args.max_message_size, keepalive_time=args.keepalive_time,
+                                   keepalive_timeout=args.keepalive_timeout, compression=args.compression)
+    with asyncio.Runner(loop_factory=event_loop_factory(args.uvloop)) as runner:
+        runner.run(serve(args.config, args.reconcile_interval, args.max_staleness, args.metrics_port,
+                         args.config_poll_interval, args.state_file, server_options, args.nodes_compression_threshold,
+                         args.batch_window, args.batch_max_nodes, args.leader_elect, args.lease_name,
+                         args.lease_namespace))
@@ -0,0 +1,74 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import os
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from node import ActionFlag, NodeStatus
+
+STATE_VERSION = 1
+
+
+class StateException(Exception):
+    """Raised when something bad happened while reading the state snapshot"""
+
+@dataclass
+class State:
+    """Snapshot of the server state restored on startup.
+    Timestamps are wall clock, monotonic clocks do not survive a restart.
+    """
+    nodes: dict[str, tuple[NodeStatus, Optional[ActionFlag]]]
+    provider: dict = field(default_factory=dict)
+    last_sync: Optional[float] = None
+    saved_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> dict:
+        return {
+                "version": STATE_VERSION,
+                "saved_at": self.saved_at,
+                "last_sync": self.last_sync,
+                "provider": self.provider,
+                "nodes": {name: [status.value, flag and flag.value] for name, (status, flag) in self.nodes.items()},
+                }
+
+    @staticmethod
+    def from_dict(state: dict) -> "State":
+        if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+            raise StateException("Unsupported state version")
+        try:
+            nodes = {name: (NodeStatus(status), flag and ActionFlag(flag)) for name, (status, flag) in state["nodes"].items()}
+            return State(nodes=nodes, provider=state.get("provider") or {},
+                         last_sync=state.get("last_sync"), saved_at=state["saved_at"])
+        except (AttributeError, KeyError, TypeError, ValueError) as exc:
+            raise StateException(f"Invalid state: {exc}") from exc
+
+
+def save_state(path, state: State):
+    """Write the snapshot to a temporary file renamed over `path`, readers never see a partial file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".state-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(state.to_dict(), f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_state(path) -> Optional[State]:
+    """Read the snapshot, None when there is no snapshot yet"""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        raise StateException(f"Could not read {path}: {exc}") from exc
+    return State.from_dict(state)
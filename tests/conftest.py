@@ -0,0 +1,7 @@
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+# Same import paths as `python src/server.py`
+sys.path.insert(0, SRC)
+sys.path.append(os.path.join(SRC, "protos"))
@@ -0,0 +1,30 @@
+from kubernetes.client import V1Node, V1NodeCondition, V1NodeSpec, V1NodeStatus, V1ObjectMeta
+
+from kube_operator import NodeInformer, OperatorStatus
+
+
+def make_node(name, ready="True"):
+    return V1Node(metadata=V1ObjectMeta(name=name), spec=V1NodeSpec(provider_id=f"test://{name}"),
+                  status=V1NodeStatus(conditions=[V1NodeCondition(type="Ready", status=ready)]))
+
+
+def test_handle_event():
+    informer = NodeInformer(None, ["node1"])
+    informer._handle_event({'type': 'ADDED', 'object': make_node("node1", ready="Unknown")})
+    informer._handle_event({'type': 'ADDED', 'object': make_node("other")})
+    assert informer.get("node1").status == OperatorStatus.DISCONNECTED
+    assert informer.get("other") is None
+
+    informer._handle_event({'type': 'MODIFIED', 'object': make_node("node1")})
+    assert informer.get("node1").status == OperatorStatus.READY
+    informer._handle_event({'type': 'DELETED', 'object': make_node("node1")})
+    assert informer.get("node1") is None
+
+
+def test_bookmark_ignored():
+    informer = NodeInformer(None, ["node1"])
+    informer._handle_event({'type': 'ADDED', 'object': make_node("node1")})
+    # The watch does not deserialize bookmarks, their object is a dict
+    informer._handle_event({'type': 'BOOKMARK', 'object': {'metadata': {'resourceVersion': '5'}}})
+    informer._handle_event({'type': 'ERROR', 'object': {'code': 500}})
+    assert informer.get("node1").status == OperatorStatus.READY
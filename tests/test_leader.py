@@ -0,0 +1,162 @@
+import copy
+import time
+
+import pytest
+from kubernetes.client.exceptions import ApiException
+
+from leader import LeaderElectionException, LeaderElector
+
+
+class FakeLeaseApi:
+    """CoordinationV1Api keeping a single Lease, with the resourceVersion check of the API server"""
+
+    def __init__(self):
+        self.lease = None
+        self.version = 0
+        self.fail = False
+        # Called once after the next read, e.g. for a write of another replica in between
+        self.after_read = None
+        self.timeouts = []
+
+    def _call(self, kwargs):
+        self.timeouts.append(kwargs.get("_request_timeout"))
+        if self.fail:
+            raise ApiException(status=500)
+
+    def _store(self, lease):
+        self.version += 1
+        lease.metadata.resource_version = str(self.version)
+        self.lease = copy.deepcopy(lease)
+
+    def read_namespaced_lease(self, name, namespace, **kwargs):
+        self._call(kwargs)
+        lease = copy.deepcopy(self.lease)
+        after_read, self.after_read = self.after_read, None
+        if after_read is not None:
+            after_read()
+        if lease is None:
+            raise ApiException(status=404)
+        return lease
+
+    def create_namespaced_lease(self, namespace, lease, **kwargs):
+        self._call(kwargs)
+        if self.lease is not None:
+            raise ApiException(status=409)
+        self._store(lease)
+
+    def replace_namespaced_lease(self, name, namespace, lease, **kwargs):
+        self._call(kwargs)
+        if lease.metadata.resource_version != self.lease.metadata.resource_version:
+            raise ApiException(status=409)
+        self._store(lease)
+
+
+def elector(api, identity, **kwargs):
+    kwargs = {"lease_duration": 1, "renew_deadline": 0.5, "retry_period": 0.05, **kwargs}
+    return LeaderElector(api, "lease", namespace="ns", identity=identity, **kwargs)
+
+
+def test_create():
+    api = FakeLeaseApi()
+    a = elector(api, "a")
+    assert not a.is_leader()
+    assert a.try_acquire_or_renew()
+    assert a.is_leader()
+    assert api.lease.spec.holder_identity == "a"
+    assert api.lease.spec.lease_transitions == 0
+
+
+def test_renew():
+    api = FakeLeaseApi()
+    a, b = elector(api, "a"), elector(api, "b")
+    assert a.try_acquire_or_renew()
+    for _ in range(12):
+        time.sleep(0.1)
+        assert a.try_acquire_or_renew()
+        assert not b.try_acquire_or_renew()
+    # Renewed for longer than the lease duration, b never took over
+    assert a.is_leader() and not b.is_leader()
+    assert api.lease.spec.holder_identity == "a"
+
+
+def test_conflict():
+    # a renews between the read and the update of b, after the lease expired for b
+    api = FakeLeaseApi()
+    a, b = elector(api, "a"), elector(api, "b")
+    assert a.try_acquire_or_renew()
+    assert not b.try_acquire_or_renew()
+    time.sleep(1.05)
+    api.after_read = a.try_acquire_or_renew
+    assert not b.try_acquire_or_renew()
+    assert not b.is_leader()
+    assert api.lease.spec.holder_identity == "a"
+
+    # a creates the lease after b found none
+    api = FakeLeaseApi()
+    a, b = elector(api, "a"), elector(api, "b")
+    api.after_read = a.try_acquire_or_renew
+    assert not b.try_acquire_or_renew()
+    assert not b.is_leader()
+    assert a.is_leader()
+    assert api.lease.spec.holder_identity == "a"
+
+
+def test_takeover_after_lease_duration():
+    api = FakeLeaseApi()
+    a, b = elector(api, "a"), elector(api, "b")
+    assert a.try_acquire_or_renew()
+    assert not b.try_acquire_or_renew()
+
+    # a stops renewing, b waits for the lease duration measured on its own clock
+    started = time.monotonic()
+    while not b.try_acquire_or_renew():
+        time.sleep(0.02)
+    assert time.monotonic() - started >= 1 - 0.05
+    assert b.is_leader()
+    assert api.lease.spec.holder_identity == "b"
+    assert api.lease.spec.lease_transitions == 1
+    assert not a.try_acquire_or_renew()
+    assert not a.is_leader()
+
+
+def test_step_down_after_renew_deadline():
+    api = FakeLeaseApi()
+    a = elector(api, "a")
+    assert a.try_acquire_or_renew()
+    api.fail = True
+    with pytest.raises(ApiException):
+        a.try_acquire_or_renew()
+    # Still the leader until the renew deadline, before the lease expires for the others
+    assert a.is_leader()
+    time.sleep(0.5)
+    assert not a.is_leader()
+
+
+def test_release():
+    api = FakeLeaseApi()
+    a, b = elector(api, "a"), elector(api, "b")
+    assert a.try_acquire_or_renew()
+    assert not b.try_acquire_or_renew()
+    a.release()
+    assert not a.is_leader()
+    assert api.lease.spec.holder_identity is None
+    # b takes over right away instead of waiting for the lease duration
+    assert b.try_acquire_or_renew()
+    assert api.lease.spec.holder_identity == "b"
+
+    # A replica that is not the leader leaves the lease alone
+    version = api.version
+    a.release()
+    assert api.version == version
+
+
+def test_request_timeout():
+    api = FakeLeaseApi()
+    a = elector(api, "a", lease_duration=15, renew_deadline=10)
+    a.try_acquire_or_renew()
+    a.try_acquire_or_renew()
+    a.release()
+    assert api.timeouts and set(api.timeouts) == {5}
+    assert elector(api, "b").request_timeout == 0.25
+    with pytest.raises(LeaderElectionException):
+        elector(api, "c", request_timeout=0.5)
@@ -0,0 +1,39 @@
+from node import ActionFlag, Node, NodeGroup, NodeStatus
+
+
+def make_group(*statuses):
+    return NodeGroup(nodes=[Node(name=f"node{i}", status=status, provider_id="test") for i, status in enumerate(statuses)])
+
+
+def test_target_size_stable_while_changes_are_applied():
+    ng = make_group(NodeStatus.RUNNING, NodeStatus.SHUTDOWN, NodeStatus.SHUTDOWN, NodeStatus.RUNNING)
+    ng.increase_size(2)
+    ng.delete_nodes(["node3"])
+    assert ng.target_size() == 3
+
+    ng.begin_apply()
+    # The provider applies the changes and clears the flags
+    for n in ng.nodes:
+        n.flag = None
+    assert ng.target_size() == 3
+
+    # The operator sync updates the status
+    ng.get_node("node1").status = NodeStatus.CREATING
+    assert ng.target_size() == 3
+    ng.get_node("node2").status = NodeStatus.CREATING
+    ng.get_node("node3").status = NodeStatus.DELETING
+    assert ng.target_size() == 3
+
+    ng.end_apply()
+    assert ng.target_size() == 3
+
+
+def test_target_size_keeps_changes_not_applied():
+    ng = make_group(NodeStatus.RUNNING, NodeStatus.SHUTDOWN)
+    ng.increase_size(1)
+    ng.begin_apply()
+    # The provider failed, the flag is kept for the next sync
+    assert ng.get_node("node1").flag == ActionFlag.TO_START
+    assert ng.target_size() == 2
+    ng.end_apply()
+    assert ng.target_size() == 2
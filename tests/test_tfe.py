@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from node import ActionFlag, Node, NodeStatus
+from providers.base import ProviderStatus
+from providers.tfe import TFEConfig, TFEProvider
+
+
+class StubTFE:
+    """Workspace with a pool variable and a runs endpoint"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.runs = []
+
+    async def get_variable(self, request):
+        return web.json_response({"data": {"id": "var-pool", "attributes": {"key": "pool", "value": json.dumps(self.pool)}}})
+
+    async def update_variable(self, request):
+        body = await request.json()
+        self.pool = json.loads(body["data"]["attributes"]["value"])
+        return web.json_response({})
+
+    async def create_run(self, request):
+        self.runs.append(await request.json())
+        return web.json_response({"data": {"id": f"run-{len(self.runs)}"}}, status=201)
+
+
+def run(api, test):
+    async def main():
+        app = web.Application()
+        app.router.add_get("/workspaces/ws/vars/var-pool", api.get_variable)
+        app.router.add_patch("/workspaces/ws/vars/var-pool", api.update_variable)
+        app.router.add_post("/runs", api.create_run)
+        async with TestServer(app, host="127.0.0.1") as server:
+            url = str(server.make_url("")).rstrip("/")
+            provider = TFEProvider([], TFEConfig(token="token", workspace="ws", api_url=url, cache_ttl=0))
+            provider.var_id = "var-pool"
+            try:
+                return await test(provider)
+            finally:
+                await provider.close()
+    return asyncio.run(main())
+
+
+def test_unmanaged_nodes_kept_in_pool():
+    # node9 was removed from the config while running
+    api = StubTFE(["node1", "node2", "node9"])
+    nodes = [Node(name=f"node{i}", status=NodeStatus.UNKNOWN, provider_id="tfe") for i in range(1, 4)]
+    nodes[1].flag = ActionFlag.TO_DELETE
+    nodes[2].flag = ActionFlag.TO_START
+
+    async def test(provider):
+        provider.set_managed_nodes(nodes)
+        return await provider.sync_status()
+
+    status = run(api, test)
+    assert sorted(api.pool) == ["node1", "node3", "node9"]
+    assert len(api.runs) == 1
+    assert status == {"node1": ProviderStatus.RUNNING, "node2": ProviderStatus.SHUTDOWN, "node3": ProviderStatus.RUNNING}
+    assert all(n.flag is None for n in nodes)
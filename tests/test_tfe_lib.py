@@ -0,0 +1,122 @@
+import asyncio
+import email.utils
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from providers.tfe_lib import BACKOFF_MAX, TFECLient, TFEConnectionError
+
+
+class StubAPI:
+    """Answer each path with the next status of its script, the last one is repeated"""
+
+    def __init__(self, scripts, delay=0):
+        self.scripts = scripts
+        self.delay = delay
+        self.calls = []
+
+    async def handle(self, request):
+        self.calls.append((request.method, request.path))
+        await asyncio.sleep(self.delay)
+        script = self.scripts[request.path]
+        status, headers = script.pop(0) if len(script) > 1 else script[0]
+        return web.json_response({"data": {"status": status}}, status=status, headers=headers)
+
+
+def run(api, test, **client_kwargs):
+    """Start the stub API, then run `test(client, url)` with a client that does not sleep between retries"""
+    async def main():
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", api.handle)
+        async with TestServer(app, host="127.0.0.1") as server:
+            client = TFECLient("token", "ws", api_url=str(server.make_url("")).rstrip("/"), **client_kwargs)
+            client.backoffs = []
+            def backoff_time(attempt, headers=None):
+                client.backoffs.append((attempt, headers and headers.get("Retry-After")))
+                return 0
+            client._backoff_time = backoff_time
+            try:
+                return await test(client, str(server.make_url("")).rstrip("/"))
+            finally:
+                await client.close()
+    return asyncio.run(main())
+
+
+def test_get_retried_until_success():
+    api = StubAPI({"/get": [(503, {}), (502, {}), (200, {})]})
+    resp = run(api, lambda client, url: client._request("GET", f"{url}/get", "test"), retries=3)
+    assert resp.status_code == 200
+    assert len(api.calls) == 3
+
+
+def test_last_response_returned_after_retries():
+    api = StubAPI({"/get": [(500, {})]})
+    resp = run(api, lambda client, url: client._request("GET", f"{url}/get", "test"), retries=2)
+    assert resp.status_code == 500
+    assert len(api.calls) == 3
+
+
+def test_client_errors_not_retried():
+    api = StubAPI({"/get": [(404, {})]})
+    resp = run(api, lambda client, url: client._request("GET", f"{url}/get", "test"), retries=3)
+    assert resp.status_code == 404
+    assert len(api.calls) == 1
+
+
+def test_post_not_retried():
+    api = StubAPI({"/runs": [(503, {}), (201, {})]})
+    resp = run(api, lambda client, url: client._request("POST", f"{url}/runs", "test", json={}), retries=3)
+    assert resp.status_code == 503
+    assert api.calls == [("POST", "/runs")]
+
+
+def test_patch_retried():
+    api = StubAPI({"/var": [(503, {}), (200, {})]})
+    resp = run(api, lambda client, url: client._request("PATCH", f"{url}/var", "test", json={}), retries=3)
+    assert resp.status_code == 200
+    assert len(api.calls) == 2
+
+
+def test_retry_after_passed_on_429_and_503():
+    api = StubAPI({"/get": [(429, {"Retry-After": "7"}), (503, {"Retry-After": "3"}), (500, {"Retry-After": "9"}), (200, {})]})
+
+    async def test(client, url):
+        resp = await client._request("GET", f"{url}/get", "test")
+        return resp, client.backoffs
+
+    resp, backoffs = run(api, test, retries=3)
+    assert resp.status_code == 200
+    # Retry-After is only honored on 429 and 503
+    assert backoffs == [(0, "7"), (1, "3"), (2, None)]
+
+
+def test_timeout_raises_connection_error():
+    api = StubAPI({"/slow": [(200, {})]}, delay=1)
+    with pytest.raises(TFEConnectionError):
+        run(api, lambda client, url: client._request("GET", f"{url}/slow", "test"), retries=1, timeout=0.2)
+    assert len(api.calls) == 2
+
+
+def test_connection_refused_raises_connection_error():
+    async def test(client, url):
+        return await client._request("GET", "http://127.0.0.1:1/get", "test")
+
+    with pytest.raises(TFEConnectionError):
+        run(StubAPI({}), test, retries=1)
+
+
+def test_backoff_time():
+    client = TFECLient("token", "ws", backoff=0.5)
+    for attempt in range(4):
+        delay = client._backoff_time(attempt)
+        assert 0.5 * 2 ** attempt <= delay <= 0.5 * 2 ** attempt + 0.5
+    assert client._backoff_time(20) == BACKOFF_MAX
+
+    assert client._backoff_time(0, {"Retry-After": "12"}) == 12
+    assert client._backoff_time(0, {"Retry-After": "100000"}) == BACKOFF_MAX
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 <= client._backoff_time(0, {"Retry-After": date}) <= 30
+    # An invalid header falls back to the backoff
+    assert 0.5 <= client._backoff_time(0, {"Retry-After": "soon"}) <= 1